@@ -0,0 +1,169 @@
+"""
+Micro-benchmarks for the performance-sensitive helpers in this app. Run them
+from `manage.py shell`, e.g.:
+
+    >>> from common import benchmarks
+    >>> benchmarks.json_codecs()
+
+Each benchmark prints and returns a dict of timings in seconds.
+"""
+import datetime
+import json
+import timeit
+from decimal import Decimal
+
+
+def _report(title, timings):
+    print title
+    fastest = min(timings.values())
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1]):
+        print '  %-32s %8.4fs  %5.2fx' % (name, seconds, seconds / fastest)
+    return timings
+
+
+def sample_payload(rows=100):
+    return [{
+        'id': i,
+        'name': u'Contact %s' % i,
+        'amount': Decimal('%d.25' % i),
+        'created': datetime.datetime(2012, 1, 1, 12, 30, i % 60, 5000),
+        'day': datetime.date(2012, 1, 1 + i % 28),
+        'tags': ['a', 'b', 'c'],
+        'active': bool(i % 2),
+    } for i in range(rows)]
+
+
+def json_codecs(payload=None, number=200):
+    """Time dumps/loads of `payload` (a list of rows by default) per codec"""
+    from common.utils import JSON_CODECS, get_json_codec
+
+    payload = payload if payload is not None else sample_payload()
+    timings = {}
+    for name in sorted(JSON_CODECS):
+        try:
+            codec = get_json_codec(name)
+        except ImportError:
+            continue
+        encoded = codec.dumps(payload)
+        # ujson only decodes; its dumps runs on simplejson or json
+        encoder = getattr(codec, 'json', json).__name__
+        timings['%s.dumps (%s)' % (name, encoder)] = timeit.timeit(lambda: codec.dumps(payload), number=number)
+        timings['%s.loads' % name] = timeit.timeit(lambda: codec.loads(encoded), number=number)
+    return _report('JSON codecs (%d iterations)' % number, timings)
+
+
+def sql_profiler(number=1000, queries_per_request=50):
+    """Per-request cost of summarizing and recording a sampled request"""
+    from common.middleware import SQLProfile
+
+    queries = [{'sql': 'SELECT "app_contact"."id", "app_contact"."name" FROM "app_contact" '
+                       'WHERE "app_contact"."account_id" = %d' % i, 'time': '0.001'}
+               for i in range(queries_per_request)]
+    profile = SQLProfile()
+    timings = {
+        'summarize': timeit.timeit(lambda: profile.summarize(queries), number=number) / number,
+        'record': timeit.timeit(lambda: profile.record('bench', queries), number=number) / number,
+    }
+    return _report('SQL profiler, %d queries per request (seconds per request)' % queries_per_request, timings)
+
+
+def _csv_mapper(row):
+    return {'name': row[0], 'email': row[1], 'amount': Decimal(row[2])}
+
+
+def csv_parse(rows=100000, processes=(1, 2, 4), batch_size=1000):
+    """Rows per second through parse_csv() for a generated file, per pool size"""
+    import csv
+    import os
+    import tempfile
+    from common.utils import parse_csv
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = csv.writer(f)
+            for i in range(rows):
+                writer.writerow(['Contact %d' % i, 'contact%d@example.com' % i, '%d.50' % i])
+
+        timings = {}
+        for count in processes:
+            seconds = timeit.timeit(lambda: sum(len(records) for records, errors in
+                                                parse_csv(path, _csv_mapper, batch_size=batch_size,
+                                                          processes=count)), number=1)
+            timings['%d process(es)' % count] = seconds
+        for name, seconds in timings.items():
+            print '  %s: %d rows/s' % (name, rows / seconds)
+        return _report('parse_csv, %d rows' % rows, timings)
+    finally:
+        os.remove(path)
+
+
+def keyset_pagination(queryset, per_page=50, pages=(1, 100, 1000, 10000), field='date_created', number=5):
+    """
+    Time fetching deep pages of `queryset` (ideally a large table) with
+    Django's Paginator versus KeysetPaginator
+    """
+    from django.core.paginator import Paginator
+    from common.utils import KeysetPaginator
+
+    paginator = Paginator(queryset.order_by('-%s' % field, '-pk'), per_page)
+    keyset = KeysetPaginator(queryset, per_page, field=field)
+
+    timings = {}
+    for number_ in pages:
+        offset = (number_ - 1) * per_page
+        rows = list(queryset.order_by('-%s' % field, '-pk')[max(offset - 1, 0):offset])
+        if offset and not rows:
+            break
+        cursor = rows and keyset.encode_cursor(rows[0]) or None
+
+        timings['offset page %d' % number_] = timeit.timeit(
+            lambda: list(paginator.page(number_).object_list), number=number) / number
+        timings['keyset page %d' % number_] = timeit.timeit(
+            lambda: list(keyset.page(cursor).object_list), number=number) / number
+    return _report('Pagination, %d per page (seconds per page)' % per_page, timings)
+
+
+def readonly_rows(queryset, limit=200000, number=1):
+    """
+    Time and approximate memory of loading `queryset` (ideally a Base model
+    table) as model instances versus BaseManager.readonly() rows, reading
+    every field once
+    """
+    import sys
+    from common.models import readonly_queryset
+
+    queryset = queryset[:limit]
+    attnames = [f.attname for f in queryset.model._meta.fields]
+
+    def consume(rows):
+        for row in rows:
+            for name in attnames:
+                getattr(row, name)
+
+    def instance_size(obj):
+        size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+        state = obj.__dict__.get('_state')
+        if state is not None:
+            size += sys.getsizeof(state) + sys.getsizeof(state.__dict__)
+        original = obj.__dict__.get('_original_values')
+        if original is not None:
+            size += sys.getsizeof(original)
+        return size
+
+    def row_size(row):
+        return sys.getsizeof(row) + sys.getsizeof(row._values)
+
+    instances = list(queryset.all())
+    rows = list(readonly_queryset(queryset.all()))
+    if instances:
+        # Both hold the same field values, so only the containers are counted
+        print '  instances: ~%d bytes per row' % (sum(instance_size(obj) for obj in instances) / len(instances))
+        print '  readonly:  ~%d bytes per row' % (sum(row_size(row) for row in rows) / len(rows))
+    del instances, rows
+
+    timings = {
+        'instances': timeit.timeit(lambda: consume(queryset.all()), number=number) / number,
+        'readonly': timeit.timeit(lambda: consume(readonly_queryset(queryset.all())), number=number) / number,
+    }
+    return _report('Loading up to %d rows (seconds per pass)' % limit, timings)
@@ -1,20 +1,23 @@
+import threading
+from contextlib import contextmanager
+
 from django import forms
+from django.core import exceptions
+from django.conf import settings
 from django.db import models, router
-from django.utils import simplejson as json
 from django.utils.translation import ugettext as _
 
-from phonenumbers import PhoneNumber
-from phonenumbers.phonenumberutil import format_number, parse, PhoneNumberFormat, NumberParseException
+from phonenumbers.phonenumberutil import NumberParseException
 
 from south.modelsinspector import add_introspection_rules
 
-from common.utils import Encoder, format_us_phone_number
+from common.utils import chunks, format_international_phone_number, format_us_phone_number, get_json_codec
 
 
 class JSONWidget(forms.Textarea):
     def render(self, name, value, attrs=None):
         if not isinstance(value, basestring):
-            value = dumps(value, indent=2)
+            value = get_json_codec().dumps(value, indent=2)
         return super(JSONWidget, self).render(name, value, attrs)
 
 
@@ -26,40 +29,125 @@ class JSONFormField(forms.CharField):
     def clean(self, value):
         if not value: return
         try:
-            return loads(value)
+            return get_json_codec().loads(value)
         except Exception, exc:
             raise forms.ValidationError(u'JSON decode error: %s' % (unicode(exc),))
 
 
+"""
+Raw JSON text loaded into a lazy JSONField that has not been parsed yet
+"""
+class RawJSON(object):
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __reduce__(self):
+        return (RawJSON, (self.raw,))
+
+
+"""
+Replaces SubfieldBase's Creator for JSONField. Eager fields convert on
+assignment just like Creator; lazy fields keep the raw string and only parse
+it on first access, caching the result on the instance. Strings assigned (as
+when loading from the database) are also kept as a snapshot for
+JSONField.changed_in_place().
+"""
+class JSONDescriptor(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, RawJSON):
+            value = obj.__dict__[self.field.name] = self.field.to_python(value.raw)
+        return value
+
+    def __set__(self, obj, value):
+        if isinstance(value, basestring):
+            obj.__dict__.setdefault('_json_snapshots', {})[self.field.name] = value
+        if self.field.lazy and isinstance(value, basestring):
+            value = RawJSON(value)
+        else:
+            value = self.field.to_python(value)
+        obj.__dict__[self.field.name] = value
+
+
 add_introspection_rules([], ["^common\.fields\.JSONField"])
 class JSONField(models.TextField):
-    __metaclass__ = models.SubfieldBase
-
     def formfield(self, **kwargs):
         return super(JSONField, self).formfield(form_class=JSONFormField, **kwargs)
 
     def __init__(self, *args, **kwargs):
-        self.dump_kwargs = kwargs.pop('dump_kwargs', {'cls': Encoder})
+        self.dump_kwargs = kwargs.pop('dump_kwargs', {})
         self.load_kwargs = kwargs.pop('load_kwargs', {})
+        self.codec = get_json_codec(kwargs.pop('codec', None))
+        self.lazy = kwargs.pop('lazy', getattr(settings, 'JSON_FIELD_LAZY', False))
 
         super(JSONField, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(JSONField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, JSONDescriptor(self))
+
     def to_python(self, value):
         """Convert our string value to JSON after we load it from the DB"""
 
+        if isinstance(value, RawJSON):
+            value = value.raw
+
         if isinstance(value, basestring):
             try:
-                return json.loads(value, **self.load_kwargs)
+                return self.codec.loads(value, **self.load_kwargs)
             except ValueError:
                 pass
 
         return value
 
+    def pre_save(self, model_instance, add):
+        """
+        Hand an untouched lazy value to get_db_prep_save without parsing it;
+        otherwise serialize here and keep the result as the new snapshot
+        """
+
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, RawJSON):
+            return value
+        value = super(JSONField, self).pre_save(model_instance, add)
+        if not isinstance(value, basestring):
+            value = self.codec.dumps(value, **self.dump_kwargs)
+            model_instance.__dict__.setdefault('_json_snapshots', {})[self.name] = value
+        return value
+
+    def changed_in_place(self, model_instance):
+        """
+        Whether the parsed value differs from what was loaded or last saved,
+        e.g. after the dict was modified in place. Unparsed values never have
+        changed; values that were never loaded or saved always have.
+        """
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, RawJSON):
+            return False
+        snapshot = model_instance.__dict__.get('_json_snapshots', {}).get(self.name)
+        if snapshot is None:
+            return True
+        if not isinstance(value, (dict, list)):
+            return self.to_python(snapshot) != value
+        if self.codec.dumps(value, **self.dump_kwargs) == snapshot:
+            return False
+        # the same value may serialize differently, e.g. in another key order
+        return self.to_python(snapshot) != value
+
     def get_db_prep_save(self, value, connection=None):
         """Convert our JSON object to a string before we save"""
 
-        if not isinstance(value, basestring):
-            value = json.dumps(value, **self.dump_kwargs)
+        if isinstance(value, RawJSON):
+            value = value.raw
+        elif not isinstance(value, basestring):
+            value = self.codec.dumps(value, **self.dump_kwargs)
 
         return super(JSONField, self).get_db_prep_save(value, connection=connection)
 
@@ -92,7 +180,7 @@ class PhoneNumberField(models.CharField):
     def to_python(self, value):
         if isinstance(value, basestring) and value != '':
             try:
-                value = format_number(parse(value,"US"),PhoneNumberFormat.INTERNATIONAL)
+                value = format_international_phone_number(value)
             except NumberParseException:
                 pass
         return value
@@ -107,7 +195,7 @@ class PhoneNumberField(models.CharField):
     def value_to_string(self, obj):
         value = self._get_val_from_obj(obj)
         try:
-            return format_number(parse(value,"US"),PhoneNumberFormat.INTERNATIONAL)
+            return format_international_phone_number(value)
         except NumberParseException:
             return value
 
@@ -119,6 +207,10 @@ Using this class, you can specify something like:
 
 person = CustomForeignKey(Person, null=True, blank=True, related_name='+', on_delete=models.SET_NULL, related_validation_manager = 'all_objects')
 
+Inside fk_validation_cache() (or a request handled by
+FKValidationCacheMiddleware), values already known to exist are not queried
+again, and validate_foreign_keys() checks many instances with one query per
+related model.
 """
 class CustomForeignKey(models.ForeignKey):
     def __init__(self, *args, **kwargs):
@@ -136,13 +228,101 @@ class CustomForeignKey(models.ForeignKey):
             return
 
         using = router.db_for_read(model_instance.__class__, instance=model_instance)
-        qs = getattr(self.rel.to, self.related_validation_manager).using(using).filter(
+        known = _fk_validation_cache()
+        key = (self.validation_key(using), self.rel.get_related_field().to_python(value))
+        if known is not None and key in known:
+            return
+
+        qs = self.validation_queryset(using).filter(
                 **{self.rel.field_name: value}
              )
-        qs = qs.complex_filter(self.rel.limit_choices_to)
         if not qs.exists():
             raise exceptions.ValidationError(self.error_messages['invalid'] % {
                 'model': self.rel.to._meta.verbose_name, 'pk': value})
+        if known is not None:
+            known.add(key)
+
+    def validation_queryset(self, using):
+        qs = getattr(self.rel.to, self.related_validation_manager).using(using)
+        return qs.complex_filter(self.rel.limit_choices_to)
+
+    def validation_key(self, using):
+        """Fields sharing this key accept exactly the same values"""
+        limit = self.rel.limit_choices_to
+        return (self.rel.to, self.related_validation_manager, self.rel.field_name, using,
+                limit and id(limit) or None)
+
+
+_fk_validation = threading.local()
+
+
+def _fk_validation_cache():
+    return getattr(_fk_validation, 'known', None)
+
+
+def reset_fk_validation_cache(**kwargs):
+    """Drop this thread's cache, e.g. one left behind by an aborted request"""
+    _fk_validation.known = None
+
+
+@contextmanager
+def fk_validation_cache():
+    """Remember related values that passed CustomForeignKey validation"""
+    if _fk_validation_cache() is not None:
+        yield _fk_validation.known
+        return
+    _fk_validation.known = set()
+    try:
+        yield _fk_validation.known
+    finally:
+        _fk_validation.known = None
+
+
+"""
+Check the CustomForeignKey values of many instances with one IN query per
+related model/manager. Returns {instance index: {field name: [message]}} for
+values that don't exist, and marks the others as valid in the active
+fk_validation_cache() so full_clean() won't query them again.
+"""
+def validate_foreign_keys(instances):
+    groups = {}
+    errors = {}
+    for idx, obj in enumerate(instances):
+        using = router.db_for_read(obj.__class__, instance=obj)
+        for field in obj._meta.fields:
+            if not isinstance(field, CustomForeignKey) or field.rel.parent_link:
+                continue
+            value = getattr(obj, field.attname)
+            if value is None:
+                continue
+            try:
+                # match the values the related field reads back, e.g. '5' as 5
+                value = field.rel.get_related_field().to_python(value)
+            except exceptions.ValidationError, e:
+                errors.setdefault(idx, {}).setdefault(field.name, []).extend(e.messages)
+                continue
+            key = field.validation_key(using)
+            group = groups.setdefault(key, (field, using, {}))
+            group[2].setdefault(value, []).append((idx, field))
+
+    known = _fk_validation_cache()
+    for key, (field, using, values) in groups.iteritems():
+        found = set()
+        for batch in chunks(values.keys(), 500):
+            found.update(field.validation_queryset(using).filter(
+                **{'%s__in' % field.rel.field_name: batch}
+            ).values_list(field.rel.field_name, flat=True))
+
+        for value, uses in values.iteritems():
+            if value in found:
+                if known is not None:
+                    known.add((key, value))
+                continue
+            for idx, instance_field in uses:
+                errors.setdefault(idx, {}).setdefault(instance_field.name, []).append(
+                    instance_field.error_messages['invalid'] % {
+                        'model': instance_field.rel.to._meta.verbose_name, 'pk': value})
+    return errors
 
 add_introspection_rules([
     (
@@ -0,0 +1,62 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from common.utils import normalize_phone_numbers
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Rewrite stored phone numbers of a model in E164 form'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fields', dest='fields', default='',
+                    help='Comma separated field names (default: every PhoneNumberField)'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000),
+        make_option('--processes', dest='processes', type='int', default=None,
+                    help='Worker processes (default: one per CPU, 1 to disable the pool)'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File holding the last processed pk, used to resume'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report unparseable values without writing anything'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Usage: normalize_phone_numbers %s' % self.args)
+        model_class = get_model(*args[0].split('.', 1))
+        if model_class is None:
+            raise CommandError('Unknown model %s' % args[0])
+
+        checkpoint = options['checkpoint']
+        start_pk = None
+        if checkpoint and os.path.exists(checkpoint):
+            start_pk = open(checkpoint).read().strip() or None
+            if start_pk and start_pk.isdigit():
+                start_pk = int(start_pk)
+            self.stdout.write('Resuming after pk %s\n' % start_pk)
+
+        def on_chunk(stats):
+            if checkpoint and not options['dry_run']:
+                with open(checkpoint, 'w') as f:
+                    f.write(str(stats['last_pk']))
+            self.stdout.write('%(rows)d rows, %(updated)d changed, last pk %(last_pk)s\n' % stats)
+
+        stats = normalize_phone_numbers(
+            model_class,
+            fields=[name for name in options['fields'].split(',') if name],
+            chunk_size=options['chunk_size'],
+            processes=options['processes'],
+            start_pk=start_pk,
+            dry_run=options['dry_run'],
+            on_chunk=on_chunk,
+        )
+
+        for pk, attname, value in stats['unparseable']:
+            self.stdout.write('Unparseable %s=%r (pk %s)\n' % (attname, value, pk))
+        self.stdout.write('Done: %d rows, %d %s, %d unparseable values\n' % (
+            stats['rows'], stats['updated'],
+            options['dry_run'] and 'would change' or 'changed',
+            len(stats['unparseable'])))
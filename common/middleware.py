@@ -1,8 +1,21 @@
+import re
+import time
+import atexit
+import random
 import datetime
+import threading
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import get_model
+from django.utils.functional import SimpleLazyObject
 from django.contrib.auth.middleware import get_user
 from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_finished
+
+from common.fields import fk_validation_cache, reset_fk_validation_cache
+from common.utils import bulk_update, get_exception_reporter
 
 
 class DebugSQLMiddleware(object):
@@ -19,19 +32,221 @@ class DebugSQLMiddleware(object):
         return response
 
 
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def fingerprint_sql(sql):
+    """Normalize a query so the same statement with other parameters matches"""
+    sql = _SQL_LITERAL_RE.sub('?', sql)
+    sql = _SQL_IN_LIST_RE.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+"""
+Per-endpoint aggregates for SQLProfilerMiddleware. Query counts and DB time
+are kept in a fixed-size random sample per endpoint for percentiles, along
+with the slowest queries and the fingerprints flagged as duplicate or N+1.
+"""
+class SQLProfile(object):
+    def __init__(self, reservoir_size=1000, slow_queries=5, n_plus_one_threshold=5):
+        self.reservoir_size = reservoir_size
+        self.slow_queries = slow_queries
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def summarize(self, queries):
+        """Summarize the queries ({'sql', 'time'} dicts) of a single request"""
+        total = 0.0
+        by_sql, by_fingerprint = {}, {}
+        timed = []
+        for query in queries:
+            duration = float(query.get('time') or query.get('duration') or 0)
+            total += duration
+            timed.append((duration, query['sql']))
+            by_sql[query['sql']] = by_sql.get(query['sql'], 0) + 1
+            fingerprint = fingerprint_sql(query['sql'])
+            by_fingerprint[fingerprint] = by_fingerprint.get(fingerprint, 0) + 1
+
+        return {
+            'count': len(queries),
+            'time': total,
+            'slowest': sorted(timed, reverse=True)[:self.slow_queries],
+            'duplicates': dict((fingerprint_sql(sql), n) for sql, n in by_sql.iteritems() if n > 1),
+            'n_plus_one': dict((fp, n) for fp, n in by_fingerprint.iteritems()
+                               if n >= self.n_plus_one_threshold),
+        }
+
+    def record(self, endpoint, queries):
+        summary = self.summarize(queries)
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'samples': [], 'slowest': [], 'duplicates': {}, 'n_plus_one': {},
+            })
+            stats['requests'] += 1
+            sample = (summary['count'], summary['time'])
+            if len(stats['samples']) < self.reservoir_size:
+                stats['samples'].append(sample)
+            else:
+                idx = random.randint(0, stats['requests'] - 1)
+                if idx < self.reservoir_size:
+                    stats['samples'][idx] = sample
+            stats['slowest'] = sorted(stats['slowest'] + summary['slowest'], reverse=True)[:self.slow_queries]
+            for key in ('duplicates', 'n_plus_one'):
+                for fingerprint, n in summary[key].iteritems():
+                    stats[key][fingerprint] = stats[key].get(fingerprint, 0) + n
+        return summary
+
+    def report(self):
+        def percentiles(values):
+            values = sorted(values)
+            return dict(('p%d' % p, values[min(len(values) - 1, len(values) * p / 100)])
+                        for p in (50, 95, 99))
+
+        report = {}
+        with self.lock:
+            for endpoint, stats in self.endpoints.iteritems():
+                report[endpoint] = {
+                    'requests': stats['requests'],
+                    'queries': percentiles([count for count, _ in stats['samples']]),
+                    'db_time': percentiles([t for _, t in stats['samples']]),
+                    'slowest': list(stats['slowest']),
+                    'duplicates': dict(stats['duplicates']),
+                    'n_plus_one': dict(stats['n_plus_one']),
+                }
+        return report
+
+sql_profile = SQLProfile()
+
+
+"""
+Production friendly replacement for DebugSQLMiddleware. A random
+SQL_PROFILER_SAMPLE_RATE fraction of requests (default 1%) run with Django's
+debug cursor, and their queries are summarized into sql_profile per view.
+Requests that never reach a view (404s, responses from other middleware) are
+grouped under UNRESOLVED_ENDPOINT rather than by path, which clients control.
+Read the aggregates with sql_profile.report() or the common.views.sql_profile
+view.
+"""
+class SQLProfilerMiddleware(object):
+    UNRESOLVED_ENDPOINT = '<unresolved>'
+
+    def __init__(self):
+        self.sample_rate = getattr(settings, 'SQL_PROFILER_SAMPLE_RATE', 0.01)
+        if not self.sample_rate:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        if random.random() >= self.sample_rate:
+            return
+        state = {}
+        for alias in connections:
+            connection = connections[alias]
+            state[alias] = (connection.use_debug_cursor, len(connection.queries))
+            connection.use_debug_cursor = True
+        request._sql_profiler_state = state
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._sql_profiler_endpoint = '%s.%s' % (view_func.__module__,
+                                                    getattr(view_func, '__name__', view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        state = getattr(request, '_sql_profiler_state', None)
+        if state is None:
+            return response
+        del request._sql_profiler_state
+
+        queries = []
+        for alias, (use_debug_cursor, start) in state.iteritems():
+            connection = connections[alias]
+            queries.extend(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+
+        endpoint = getattr(request, '_sql_profiler_endpoint', self.UNRESOLVED_ENDPOINT)
+        sql_profile.record(endpoint, queries)
+        return response
+
+
+"""
+Prints tracebacks when DEBUG is on. With EXCEPTION_REPORTING enabled it feeds
+the background ExceptionReporter in production instead.
+"""
 class ExceptionMiddleware(object):
     def __init__(self):
-        if not settings.DEBUG:
+        if not settings.DEBUG and not getattr(settings, 'EXCEPTION_REPORTING', False):
             raise MiddlewareNotUsed()
 
     def process_exception(self, request, exception):
-        import traceback
-        traceback.print_exc()
+        if settings.DEBUG:
+            import traceback
+            traceback.print_exc()
+        else:
+            get_exception_reporter().report(context={
+                'path': request.path,
+                'method': request.method,
+                'user': getattr(request, 'user', None),
+            })
 
 
+def get_cached_user(request):
+    """get_user() backed by the cache for AUTH_USER_CACHE_TIMEOUT seconds"""
+    from django.contrib.auth import SESSION_KEY
+    from django.contrib.auth.models import AnonymousUser
+    from common.models import user_cache_key
+
+    try:
+        user_id = request.session[SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+
+    key = user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = get_user(request)
+        if user.is_authenticated():
+            cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+    return user
+
+
+"""
+request.user is only looked up when first used. Set AUTH_USER_CACHE_TIMEOUT to
+also keep users in the cache between requests; common.models drops the cached
+copy whenever a User is saved or deleted.
+"""
 class AuthenticationMiddleware(object):
     def process_request(self, request):
-        request.user = get_user(request)
+        if getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 0):
+            request.user = SimpleLazyObject(lambda: get_cached_user(request))
+        else:
+            request.user = SimpleLazyObject(lambda: get_user(request))
+
+
+"""
+Scope a CustomForeignKey validation cache to each request. process_response()
+is skipped when a later response middleware raises, so the thread's cache is
+also dropped when the request finishes and before the next one starts.
+"""
+class FKValidationCacheMiddleware(object):
+    def __init__(self):
+        request_finished.connect(reset_fk_validation_cache,
+                                 dispatch_uid='common.middleware.reset_fk_validation_cache')
+
+    def process_request(self, request):
+        reset_fk_validation_cache()
+        request._fk_validation_cache = fk_validation_cache()
+        request._fk_validation_cache.__enter__()
+
+    def process_response(self, request, response):
+        cache_context = getattr(request, '_fk_validation_cache', None)
+        if cache_context is not None:
+            del request._fk_validation_cache
+            cache_context.__exit__(None, None, None)
+        return response
 
 
 class SSLMiddleware:
@@ -53,13 +268,100 @@ class SSLMiddleware:
 
 
 """
-Use with caution as this will save() on every request.  
+Records last_login for LastLoginMiddleware and friends. Only the last_login
+column is written, at most once per user per LAST_LOGIN_INTERVAL seconds
+(tracked in the cache so it holds across processes). With LAST_LOGIN_BATCH_SIZE
+above 1, writes are buffered in memory and flushed as one UPDATE ... CASE when
+the batch fills up, or by a timer LAST_LOGIN_FLUSH_INTERVAL seconds after the
+first buffered write, so an idle process doesn't hold them back. The writes
+bypass save() and leave get_cached_user() entries alone, so a cached user
+may show an older last_login until the entry expires; evicting it on every
+flush would defeat AUTH_USER_CACHE_TIMEOUT.
+"""
+class LastLoginRecorder(object):
+    def __init__(self, interval=None, batch_size=None, flush_interval=None):
+        self.interval = interval if interval is not None else getattr(settings, 'LAST_LOGIN_INTERVAL', 0)
+        self.batch_size = batch_size or getattr(settings, 'LAST_LOGIN_BATCH_SIZE', 1)
+        self.flush_interval = flush_interval if flush_interval is not None else \
+            getattr(settings, 'LAST_LOGIN_FLUSH_INTERVAL', 60)
+        self.pending = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.timer = None
+        atexit.register(self.flush)
+
+    def touch(self, user):
+        now = datetime.datetime.utcnow()
+        user.last_login = now
+
+        if self.interval and not cache.add('last_login:%s' % user.pk, True, self.interval):
+            return
+
+        with self.lock:
+            # request.user may be a lazy proxy, so go by _meta rather than __class__
+            self.pending[(user._meta.app_label, user._meta.object_name, user.pk)] = now
+            due = len(self.pending) >= self.batch_size or \
+                time.time() - self.last_flush >= self.flush_interval
+            if not due and self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+        if due:
+            self.flush()
+
+    def flush_on_timer(self):
+        try:
+            self.flush()
+        finally:
+            for alias in connections:
+                connections[alias].close()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        by_model = {}
+        for (app_label, object_name, pk), last_login in pending.iteritems():
+            by_model.setdefault((app_label, object_name), []).append((pk, last_login))
+
+        for (app_label, object_name), logins in by_model.iteritems():
+            model_class = get_model(app_label, object_name)
+            if len(logins) == 1:
+                pk, last_login = logins[0]
+                model_class._default_manager.filter(pk=pk).update(last_login=last_login)
+            else:
+                bulk_update(model_class, [_LastLogin(pk, last_login) for pk, last_login in logins],
+                            fields=['last_login'])
+
+
+class _LastLogin(object):
+    def __init__(self, pk, last_login):
+        self.pk = pk
+        self.last_login = last_login
+
+
+_last_login_recorder = None
+
+
+def get_last_login_recorder():
+    global _last_login_recorder
+    if _last_login_recorder is None:
+        _last_login_recorder = LastLoginRecorder()
+    return _last_login_recorder
+
+
+"""
+Records last_login on every authenticated request, throttled and batched by
+LastLoginRecorder.
 """
 class LastLoginMiddleware(object):
     def process_request(self, request):
         if request.user and request.user.is_authenticated():
-            request.user.last_login = datetime.datetime.utcnow()
-            request.user.save()
+            get_last_login_recorder().touch(request.user)
 
 
 """
@@ -68,6 +370,5 @@ Useful if you only want to ignore api or non-template responses.
 class LastLoginByTemplatedResponseMiddleware(object):
     def process_template_response(self, request, response):
         if request.user and request.user.is_authenticated():
-            request.user.last_login = datetime.datetime.utcnow()
-            request.user.save()
+            get_last_login_recorder().touch(request.user)
         return response
@@ -1,10 +1,21 @@
 import datetime
 
-from django.db import models
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import models, router
+from django.db.models import Q
+from django.db.models.query import ValuesListQuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.contrib.auth.models import User
 from django.db.models.fields import EmailField
 from django.contrib.localflavor.us.us_states import STATE_CHOICES
 
 from common import fields as common_fields
+from common.utils import bulk_update, chunks, query_batch_size
+
+
+# Marks an original value that was never loaded (e.g. a deferred field)
+_UNKNOWN = object()
 
 
 """
@@ -17,16 +28,111 @@ EmailField._original__init__ = EmailField.__init__
 EmailField.__init__ = email_field_init
 
 
+"""
+Manager for Base models with batched writes that keep Base.save() semantics
+(validation and date_created/date_updated stamping)
+"""
+class BaseManager(models.Manager):
+    def bulk_save(self, instances, batch_size=500, fields=None, skip_validation=False,
+                  update_timestamps=True):
+        """
+        Validate, timestamp and write many instances in batches. Instances
+        without a pk are inserted with bulk_create(), the rest are updated with
+        bulk_update(). Batches are shrunk to fit the database's parameter limit,
+        and date_updated is always written when update_timestamps is set.
+        Returns a tuple of (inserted, updated) instances. bulk_create() does
+        not read back primary keys, so inserted instances keep pk None.
+        """
+        instances = list(instances)
+
+        if not skip_validation:
+            with common_fields.fk_validation_cache():
+                # One query per related model instead of one per instance;
+                # full_clean() finds the valid values in the cache and skips
+                # the ones already reported
+                fk_errors = common_fields.validate_foreign_keys(instances)
+                errors = {}
+                for idx, obj in enumerate(instances):
+                    obj_errors = dict(fk_errors.get(idx, {}))
+                    try:
+                        obj.full_clean(exclude=obj_errors.keys())
+                    except ValidationError, exc:
+                        for name, messages in exc.message_dict.iteritems():
+                            obj_errors.setdefault(name, []).extend(messages)
+                    if obj_errors:
+                        errors[idx] = ValidationError(obj_errors).messages
+            if errors:
+                raise ValidationError(errors)
+
+        inserted = [obj for obj in instances if obj.pk is None]
+        updated = [obj for obj in instances if obj.pk is not None]
+
+        if update_timestamps:
+            now = datetime.datetime.utcnow()
+            for obj in inserted:
+                if not obj.date_created:
+                    obj.date_created = now
+            for obj in instances:
+                obj.date_updated = now
+            opts = self.model._meta
+            if (fields and 'date_updated' not in fields
+                    and opts.get_field('date_updated') in opts.local_fields):
+                fields = list(fields) + ['date_updated']
+
+        insert_size = query_batch_size(self.db, len(self.model._meta.local_fields), batch_size)
+        for batch in chunks(inserted, insert_size):
+            self.bulk_create(batch)
+        self.bulk_update(updated, fields=fields, batch_size=batch_size)
+
+        for obj in inserted:
+            obj._original_values = {}
+
+        return inserted, updated
+
+    def bulk_update(self, instances, fields=None, batch_size=500):
+        """
+        Write the given fields (all of the model's own concrete fields by
+        default) of saved instances with one UPDATE ... CASE statement per
+        batch. Like QuerySet.update(), this does not call save() or send
+        signals.
+        """
+        instances = list(instances)
+        bulk_update(self.model, instances, fields=fields, batch_size=batch_size, using=self.db)
+        for obj in instances:
+            obj._original_values = {}
+
+    def readonly(self):
+        """Queryset of lightweight read-only rows; see ReadOnlyRow"""
+        return readonly_queryset(self.get_query_set())
+
+
 """
 Soft-delete management through an is_active flag on any model
 """
-class ActiveManager(models.Manager):
+class ActiveManager(BaseManager):
     def get_query_set(self):
         return super(ActiveManager, self).get_query_set().filter(is_active=True)
 
 
 """
 Abstract model used as the basis for most application level models
+
+Changes are tracked per concrete field: the original value of a field is
+recorded the first time it is assigned after load/save, so untouched
+instances carry no snapshot at all. JSONField values can also be changed
+in place without an assignment, so parsed ones are compared with the JSON
+loaded or last saved (see JSONField.changed_in_place).
+
+save(dirty_only=True) writes only the changed columns with an UPDATE. It
+still runs Field.pre_save() (auto_now and friends) and sends pre_save and
+post_save; if the row no longer exists it falls back to a full save(),
+which sends pre_save a second time.
+
+Every subclass gets objects = BaseManager(). As with any manager inherited
+from an abstract model, it is the default manager only for subclasses that
+declare no manager of their own; a subclass with just active =
+ActiveManager() keeps `active` as its default manager and also gains an
+unfiltered `objects`.
 """
 class Base(models.Model):
     date_created = models.DateTimeField(blank=True, editable=False)
@@ -36,26 +142,392 @@ class Base(models.Model):
         abstract = True
         ordering = ('-date_created',)
 
+    objects = BaseManager()
+
+    # When True (or with save(incremental_validation=True)), saving an
+    # existing row only validates the fields that changed; see clean_dirty().
+    incremental_validation = False
+
+    # When True, every save() of an existing row records the names of the
+    # fields it changed in ChangedFields, for ChangeFeed(include_fields=True).
+    track_changed_fields = False
+
     def __init__(self, *args, **kwargs):
         super(Base, self).__init__(*args, **kwargs)
-        self._original_values = self.__dict__.copy()
+        self._original_values = {}
+
+    def __setattr__(self, name, value):
+        original_values = self.__dict__.get('_original_values')
+        if original_values is not None and name not in original_values \
+                and name in self._tracked_fields():
+            original_values[name] = self.__dict__.get(name, _UNKNOWN)
+        super(Base, self).__setattr__(name, value)
+
+    @classmethod
+    def _tracked_fields(cls):
+        try:
+            return cls.__dict__['_tracked_field_names']
+        except KeyError:
+            cls._tracked_field_names = frozenset(f.attname for f in cls._meta.fields)
+            return cls._tracked_field_names
+
+    @classmethod
+    def _mutable_fields(cls):
+        try:
+            return cls.__dict__['_mutable_field_names']
+        except KeyError:
+            cls._mutable_field_names = tuple(f.attname for f in cls._meta.fields
+                                             if isinstance(f, common_fields.JSONField))
+            return cls._mutable_field_names
 
     def save(self, *args, **kwargs):
-        if not kwargs.pop('skip_validation', False):
-            self.full_clean() 
+        dirty_only = kwargs.pop('dirty_only', False)
+        skip_validation = kwargs.pop('skip_validation', False)
+        update_timestamps = kwargs.pop('update_timestamps', True)
+        incremental_validation = kwargs.pop('incremental_validation', self.incremental_validation)
 
-        if kwargs.pop('update_timestamps', True):
+        if dirty_only and not self._state.adding and not args and not kwargs.get('force_insert'):
+            if not self.get_dirty_fields():
+                return
+        else:
+            dirty_only = False
+
+        changed = None
+        if self.track_changed_fields and not self._state.adding and not kwargs.get('force_insert'):
+            dirty = self.get_dirty_fields()
+            changed = [f.name for f in self._meta.fields
+                       if f.attname in dirty and f.name not in ('date_created', 'date_updated')]
+
+        if skip_validation:
+            self.skipped_validation = [f.name for f in self._meta.fields]
+        elif incremental_validation and not self._state.adding:
+            self.clean_dirty()
+        else:
+            self.full_clean()
+            self.skipped_validation = []
+
+        if update_timestamps:
             now = datetime.datetime.utcnow()
-            if not self.pk and not self.date_created:
+            if self._state.adding and not self.date_created:
                 self.date_created = now
             self.date_updated = now
-        super(Base, self).save(*args, **kwargs)
 
-        self._original_values = self.__dict__.copy()
+        if not dirty_only or not self._save_dirty_fields(kwargs.get('using')):
+            super(Base, self).save(*args, **kwargs)
+
+        if changed:
+            ChangedFields.record(self, changed, using=kwargs.get('using'))
+
+        self._original_values = {}
+
+    def _save_dirty_fields(self, using=None):
+        """UPDATE only the changed columns; returns False if the row is gone"""
+        cls = self.__class__
+        using = using or router.db_for_write(cls, instance=self)
+        pre_save.send(sender=cls, instance=self, raw=False, using=using)
+
+        # pre_save() may assign (auto_now), which marks the field dirty, and
+        # JSONField.pre_save() refreshes the snapshot in-place changes are
+        # detected against, so check before and after
+        dirty = set(self.get_dirty_fields())
+        values = [(f, f.pre_save(self, False)) for f in self._meta.local_fields if not f.primary_key]
+        dirty.update(self.get_dirty_fields())
+        values = dict((f.name, value) for f, value in values if f.attname in dirty)
+        if not cls._base_manager.using(using).filter(pk=self.pk).update(**values):
+            return False
+
+        post_save.send(sender=cls, instance=self, created=False, raw=False, using=using)
+        return True
+
+    def clean_fields(self, exclude=None):
+        """Lazy JSONFields that were never parsed hold what was loaded; skip them"""
+        exclude = list(exclude or [])
+        exclude.extend(name for name in self._mutable_fields()
+                       if isinstance(self.__dict__.get(name), common_fields.RawJSON))
+        super(Base, self).clean_fields(exclude=exclude)
+
+    def clean_dirty(self):
+        """
+        full_clean() limited to the fields changed since the last save(), plus
+        the other fields of any unique_together set they belong to, so their
+        uniqueness is still checked. Model.clean() always runs. The names of
+        the fields that were not validated are returned and kept in
+        self.skipped_validation.
+        """
+        dirty = self.get_dirty_fields()
+        checked = set(f.name for f in self._meta.fields if f.attname in dirty)
+        for unique_together in self._meta.unique_together:
+            if checked.intersection(unique_together):
+                checked.update(unique_together)
+
+        exclude = [f.name for f in self._meta.fields if f.name not in checked]
+        self.full_clean(exclude=exclude)
+        self.skipped_validation = exclude
+        return exclude
+
+    """
+    Return {attname: original value} for the fields changed since the last
+    save(). JSONField containers changed in place are included with None as
+    the original value.
+    """
+    def get_dirty_fields(self):
+        dirty = {}
+        for name, original in self._original_values.iteritems():
+            if original is _UNKNOWN:
+                dirty[name] = None
+            elif self.__dict__.get(name) != original:
+                dirty[name] = original
+        for name in self._mutable_fields():
+            if name not in dirty and isinstance(self.__dict__.get(name), (dict, list)) \
+                    and self._meta.get_field(name).changed_in_place(self):
+                dirty[name] = self._original_values.get(name)
+        return dirty
 
     """Determine if an attribute has changed since the last save()"""
     def has_changed(self, field):
-        if not self.pk:
+        if self._state.adding:
             return False
-        return getattr(self, field) != self._original_values[field]
+        return field in self.get_dirty_fields()
+
+
+"""
+Lightweight read-only stand-in for a model instance, produced by
+BaseManager.readonly() / readonly_queryset()
+
+Rows keep the tuple fetched by values_list() in a single slot and expose the
+concrete fields by attname (foreign keys as `<name>_id`). Fields that convert
+values on load (SubfieldBase fields such as PhoneNumberField and
+TrimmedCharField, and JSONField) only run to_python() on first access, and
+the result is cached in a per-field slot. There is no model construction,
+change tracking or related object access, and rows cannot be saved.
+"""
+class ReadOnlyRow(object):
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.pk)
+
+    def save(self, *args, **kwargs):
+        raise TypeError('%s is read-only and cannot be saved' % self.__class__.__name__)
+
+    def delete(self, *args, **kwargs):
+        raise TypeError('%s is read-only and cannot be deleted' % self.__class__.__name__)
+
+
+class ReadOnlyField(object):
+    __slots__ = ('index', 'to_python', 'cache_name')
+
+    def __init__(self, index, to_python=None, cache_name=None):
+        self.index = index
+        self.to_python = to_python
+        self.cache_name = cache_name
+
+    def __get__(self, row, type=None):
+        if row is None:
+            return self
+        if self.to_python is None:
+            return row._values[self.index]
+        try:
+            return getattr(row, self.cache_name)
+        except AttributeError:
+            value = self.to_python(row._values[self.index])
+            setattr(row, self.cache_name, value)
+            return value
+
+    def __set__(self, row, value):
+        raise AttributeError('%s is read-only' % row.__class__.__name__)
+
+
+_readonly_row_classes = {}
+
+def readonly_row_class(model):
+    try:
+        return _readonly_row_classes[model]
+    except KeyError:
+        pass
+
+    slots, attrs = [], {}
+    for index, field in enumerate(model._meta.fields):
+        if isinstance(field, common_fields.JSONField) or isinstance(type(field), models.SubfieldBase):
+            cache_name = '_%s_value' % field.attname
+            slots.append(cache_name)
+            attrs[field.attname] = ReadOnlyField(index, field.to_python, cache_name)
+        else:
+            attrs[field.attname] = ReadOnlyField(index)
+    attrs['pk'] = attrs[model._meta.pk.attname]
+    attrs['__slots__'] = tuple(slots)
+    attrs['__module__'] = model.__module__
+
+    row_class = _readonly_row_classes[model] = type('ReadOnly%s' % model.__name__, (ReadOnlyRow,), attrs)
+    return row_class
+
+
+class ReadOnlyQuerySet(ValuesListQuerySet):
+    def iterator(self):
+        row_class = readonly_row_class(self.model)
+        for values in super(ReadOnlyQuerySet, self).iterator():
+            yield row_class(values)
+
+
+def readonly_queryset(queryset):
+    """Turn any queryset into one yielding ReadOnlyRow objects"""
+    fields = [f.name for f in queryset.model._meta.fields]
+    return queryset._clone(klass=ReadOnlyQuerySet, setup=True, flat=False, _fields=fields)
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+"""
+Field names changed by each save() of a Base model with track_changed_fields
+"""
+class ChangedFields(models.Model):
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    date_updated = models.DateTimeField(db_index=True)
+    fields = models.TextField()
+
+    @classmethod
+    def record(cls, instance, fields, using=None):
+        using = using or router.db_for_write(instance.__class__, instance=instance)
+        cls.objects.using(using).create(model=model_label(instance.__class__),
+                                        object_pk=unicode(instance.pk),
+                                        date_updated=instance.date_updated,
+                                        fields=','.join(fields))
+
+    @classmethod
+    def prune(cls, before):
+        """Drop the records older than every consumer's checkpoint"""
+        cls.objects.filter(date_updated__lt=before).delete()
+
+
+"""
+Last (date_updated, pk) a ChangeFeed consumer has processed, per model
+"""
+class ChangeFeedCheckpoint(models.Model):
+    consumer = models.CharField(max_length=100)
+    model = models.CharField(max_length=100)
+    date_updated = models.DateTimeField()
+    object_pk = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('consumer', 'model')
+
+
+"""
+Incremental feed of the rows changed since a high-water mark
+
+Rows are read in (date_updated, pk) order, chunk_size at a time, strictly
+after the mark, so rows sharing a timestamp are neither skipped nor repeated
+across chunks. Iterating a feed with a consumer name starts from that
+consumer's checkpoint and advances it after each chunk has been processed,
+i.e. when the next chunk is requested or the feed is exhausted; a consumer
+that fails midway gets the unfinished chunk again on its next pull.
+
+A row committed with a timestamp older than rows already pulled (a long
+transaction) is missed by a mark past it; `lag` (seconds) keeps the feed
+that far behind the clock to leave room for in-flight transactions.
+
+With include_fields, every row gets a `changed_fields` attribute: the sorted
+names of the fields changed since the mark, as recorded for models with
+track_changed_fields, or None when nothing was recorded (new rows, models
+without tracking).
+"""
+class ChangeFeed(object):
+    def __init__(self, queryset, consumer=None, chunk_size=1000, field='date_updated',
+                 include_fields=False, lag=0):
+        if isinstance(queryset, type) and issubclass(queryset, models.Model):
+            queryset = queryset._default_manager.all()
+        self.queryset = queryset
+        self.model = queryset.model
+        self.consumer = consumer
+        self.chunk_size = int(chunk_size)
+        self.field = field
+        self.include_fields = include_fields
+        self.lag = lag
+
+    def __iter__(self):
+        for chunk in self.iter_chunks(self.get_checkpoint()):
+            yield chunk
+            self.save_checkpoint(self.mark(chunk[-1]))
+
+    def mark(self, obj):
+        return getattr(obj, self.field), obj.pk
+
+    def iter_chunks(self, since=None):
+        """Yield lists of the rows changed after the mark `since`"""
+        qs = self.queryset
+        if self.lag:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.lag)
+            qs = qs.filter(**{'%s__lt' % self.field: cutoff})
+        qs = qs.order_by(self.field, 'pk')
+        start = since
+
+        while True:
+            chunk = qs
+            if since is not None:
+                value, pk = since
+                chunk = chunk.filter(Q(**{'%s__gt' % self.field: value}) |
+                                     Q(**{self.field: value, 'pk__gt': pk}))
+            rows = list(chunk[:self.chunk_size])
+            if not rows:
+                return
+            if self.include_fields:
+                # changes since the feed's mark, not just since the last chunk
+                self.add_changed_fields(rows, start)
+            yield rows
+            if len(rows) < self.chunk_size:
+                return
+            since = self.mark(rows[-1])
+
+    def add_changed_fields(self, rows, since=None):
+        records = ChangedFields.objects.filter(model=model_label(self.model),
+                                               object_pk__in=[unicode(obj.pk) for obj in rows])
+        if since is not None:
+            records = records.filter(date_updated__gte=since[0])
+
+        changed = {}
+        for object_pk, fields in records.values_list('object_pk', 'fields'):
+            changed.setdefault(object_pk, set()).update(fields.split(','))
+        for obj in rows:
+            fields = changed.get(unicode(obj.pk))
+            obj.changed_fields = fields is not None and sorted(fields) or None
+
+    def get_checkpoint(self):
+        if not self.consumer:
+            return None
+        try:
+            checkpoint = ChangeFeedCheckpoint.objects.get(consumer=self.consumer,
+                                                          model=model_label(self.model))
+        except ChangeFeedCheckpoint.DoesNotExist:
+            return None
+        return checkpoint.date_updated, self.model._meta.pk.to_python(checkpoint.object_pk)
+
+    def save_checkpoint(self, mark):
+        if not self.consumer:
+            return
+        value, pk = mark
+        label = model_label(self.model)
+        updated = ChangeFeedCheckpoint.objects.filter(consumer=self.consumer, model=label) \
+            .update(date_updated=value, object_pk=unicode(pk))
+        if not updated:
+            ChangeFeedCheckpoint.objects.create(consumer=self.consumer, model=label,
+                                                date_updated=value, object_pk=unicode(pk))
+
+
+"""
+Users cached by common.middleware.get_cached_user are dropped on save/delete
+"""
+def user_cache_key(user_id):
+    return 'common:user:%s' % user_id
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    cache.delete(user_cache_key(instance.pk))
 
+post_save.connect(invalidate_cached_user, sender=User)
+post_delete.connect(invalidate_cached_user, sender=User)
@@ -5,7 +5,53 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.db import models
+from django.test import TestCase, TransactionTestCase
+from django.conf.urls import patterns, url
+from django.contrib.auth.models import User
+
+from common import fields as common_fields
+from common.models import ActiveManager, Base
+
+
+# Registered under this app before the test database is created, so syncdb
+# builds its table.
+class Gadget(Base):
+    name = models.CharField(max_length=50)
+    kind = models.CharField(max_length=20, blank=True)
+    code = models.CharField(max_length=20, unique=True)
+    data = common_fields.JSONField(lazy=True, null=True, blank=True)
+    owner = common_fields.CustomForeignKey(User, null=True, blank=True)
+    reviewer = common_fields.CustomForeignKey(User, null=True, blank=True, related_name='+',
+                                              limit_choices_to={'is_staff': True})
+
+    class Meta:
+        app_label = 'common'
+        unique_together = ('name', 'kind')
+
+
+class Contact(Base):
+    phone = common_fields.PhoneNumberField(max_length=30, blank=True)
+    fax = common_fields.PhoneNumberField(max_length=30, blank=True)
+
+    class Meta:
+        app_label = 'common'
+
+
+class Sprocket(Base):
+    is_active = models.BooleanField(default=True)
+
+    active = ActiveManager()
+
+    class Meta:
+        app_label = 'common'
+
+
+# URLconf for tests that set `urls = 'common.tests'`
+urlpatterns = patterns('',
+    url(r'^gadgets/(\d+)/$', 'common.views.su', name='common-test-gadget'),
+    url(r'^gadgets/(?P<slug>[a-z]+)/$', 'common.views.su', name='common-test-gadget-slug'),
+)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +60,926 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class IterSqlTest(TestCase):
+    def setUp(self):
+        import sqlite3
+        self.cursor = sqlite3.connect(':memory:').cursor()
+        self.cursor.execute('CREATE TABLE t (a INTEGER, b TEXT)')
+        self.cursor.executemany('INSERT INTO t VALUES (?, ?)', [(i, str(i)) for i in range(5)])
+
+    def test_row_factories(self):
+        from common.utils import iter_sql, sql
+
+        query = 'SELECT a, b FROM t WHERE a < ? ORDER BY a'
+        self.assertEqual(list(iter_sql(self.cursor, query, (2,), 'tuple', chunk_size=1)),
+                         [(0, '0'), (1, '1')])
+        self.assertEqual(sql(self.cursor, query, (1,)), [{'a': 0, 'b': '0'}])
+        row = list(iter_sql(self.cursor, query, (2,), 'namedtuple'))[1]
+        self.assertEqual((row.a, row.b), (1, '1'))
+
+    def test_columns(self):
+        from common.utils import iter_sql
+
+        chunks = list(iter_sql(self.cursor, 'SELECT a FROM t ORDER BY a', row_factory='columns', chunk_size=3))
+        self.assertEqual(chunks, [{'a': [0, 1, 2]}, {'a': [3, 4]}])
+
+
+class JSONCodecTest(TestCase):
+    def test_codecs_match_encoder(self):
+        import datetime, json
+        from decimal import Decimal
+        from common.utils import Encoder, JSON_CODECS, UltraJSONCodec, get_json_codec
+
+        payload = {'d': Decimal('1.10'), 'dt': datetime.datetime(2012, 1, 2, 3, 4, 5, 6),
+                   'day': datetime.date(2012, 1, 2), 'l': [1, u'x']}
+        expected = json.loads(json.dumps(payload, cls=Encoder))
+        for name in JSON_CODECS:
+            try:
+                codec = get_json_codec(name)
+            except ImportError:
+                continue
+            self.assertEqual(codec.loads(codec.dumps(payload)), expected)
+
+        # ujson installed without simplejson encodes through the stdlib json
+        codec = UltraJSONCodec.__new__(UltraJSONCodec)
+        codec.json = json
+        self.assertEqual(json.loads(codec.dumps(payload)), expected)
+
+    def test_auto_skips_ujson(self):
+        from common.utils import UltraJSONCodec, get_json_codec
+
+        self.assertFalse(isinstance(get_json_codec('auto'), UltraJSONCodec))
+        try:
+            codec = get_json_codec('ujson')
+        except ImportError:
+            return
+        self.assertEqual(codec.loads('[0.1, 1.0000000000000002]'), [0.1, 1.0000000000000002])
+
+    def test_unknown_objects_raise(self):
+        from common.utils import get_json_codec
+
+        self.assertRaises(TypeError, get_json_codec('json').dumps, object())
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction_and_stats(self):
+        from common.utils import LRUCache
+
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.info(), {'hits': 1, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    def test_e164_short_circuit(self):
+        from common.utils import format_us_phone_number, phone_number_cache_info
+
+        before = phone_number_cache_info()['e164']['misses']
+        self.assertEqual(format_us_phone_number('+14155552671'), '+14155552671')
+        self.assertEqual(phone_number_cache_info()['e164']['misses'], before)
+
+
+class SQLProfileTest(TestCase):
+    def test_fingerprint(self):
+        from common.middleware import fingerprint_sql
+
+        self.assertEqual(fingerprint_sql("SELECT * FROM t WHERE a = 12 AND b = 'x''y' AND c IN (1, 2, 3)"),
+                         "SELECT * FROM t WHERE a = ? AND b = ? AND c IN (...)")
+
+    def test_record(self):
+        from common.middleware import SQLProfile
+
+        profile = SQLProfile(n_plus_one_threshold=3)
+        queries = [{'sql': 'SELECT * FROM t WHERE id = %d' % i, 'time': '0.010'} for i in range(3)]
+        queries.append({'sql': 'SELECT * FROM t WHERE id = 0', 'time': '0.500'})
+        summary = profile.record('view', queries)
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['slowest'][0], (0.5, 'SELECT * FROM t WHERE id = 0'))
+        self.assertEqual(summary['duplicates'], {'SELECT * FROM t WHERE id = ?': 2})
+        self.assertEqual(summary['n_plus_one'], {'SELECT * FROM t WHERE id = ?': 4})
+        self.assertEqual(profile.report()['view']['queries']['p99'], 4)
+
+
+class SQLProfilerMiddlewareTest(TestCase):
+    def test_sampled_requests(self):
+        from django.db import connection
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+        from common.middleware import SQLProfilerMiddleware, sql_profile
+        from common.views import sql_profile as sql_profile_view
+
+        sql_profile.reset()
+        debug_cursor = connection.use_debug_cursor
+        factory = RequestFactory()
+
+        with override_settings(SQL_PROFILER_SAMPLE_RATE=1.0):
+            middleware = SQLProfilerMiddleware()
+        for path in ('/missing/1/', '/missing/2/', '/resolved/'):
+            request = factory.get(path)
+            middleware.process_request(request)
+            self.assertTrue(connection.use_debug_cursor)
+            if path == '/resolved/':
+                middleware.process_view(request, sql_profile_view, (), {})
+            User.objects.count()
+            middleware.process_response(request, None)
+            self.assertEqual(connection.use_debug_cursor, debug_cursor)
+
+        report = sql_profile.report()
+        self.assertEqual(sorted(report), ['<unresolved>', 'common.views.sql_profile'])
+        self.assertEqual(report['<unresolved>']['requests'], 2)
+        self.assertEqual(report['<unresolved>']['queries']['p50'], 1)
+
+        with override_settings(SQL_PROFILER_SAMPLE_RATE=1e-12):
+            middleware = SQLProfilerMiddleware()
+        request = factory.get('/')
+        middleware.process_request(request)
+        self.assertFalse(hasattr(request, '_sql_profiler_state'))
+        sql_profile.reset()
+
+
+class ExceptionReporterTest(TestCase):
+    def test_digest_per_fingerprint(self):
+        from django.core import mail
+        from django.test.utils import override_settings
+        from common.utils import ExceptionReporter
+
+        # no worker thread, so nothing races flush() for the queue
+        reporter = ExceptionReporter(window=3600, max_emails=10, background=False)
+        for i in range(5):
+            try:
+                {}['missing']
+            except KeyError:
+                reporter.report(vars=False)
+        try:
+            int('x')
+        except ValueError:
+            reporter.report(vars=False)
+
+        with override_settings(ADMINS=(('Admin', 'admin@example.com'),)):
+            reporter.flush()
+
+        subjects = sorted(message.subject for message in mail.outbox)
+        self.assertEqual(len(subjects), 2)
+        self.assertTrue('KeyError (5 times' in subjects[0])
+        self.assertTrue('ValueError (1 times' in subjects[1])
+
+
+class SafeReprTest(TestCase):
+    def test_truncation_and_denylist(self):
+        from django.contrib.auth.models import User
+        from common.utils import SafeRepr
+
+        safe_repr = SafeRepr(max_value=50)
+        self.assertTrue(len(safe_repr.repr('x' * 1000)) <= 50)
+        self.assertTrue(safe_repr.repr(range(1000)).endswith('...]'))
+        with self.assertNumQueries(0):
+            self.assertTrue('not evaluated' in safe_repr.repr({'users': User.objects.all()}))
+
+    def test_nested_containers(self):
+        from common.utils import SafeRepr
+
+        nested = [[['y' * 2000] * 20] * 20] * 20
+        self.assertTrue(len(SafeRepr(max_value=1024).repr(nested)) <= 1024)
+        self.assertTrue(len(SafeRepr(max_value=1024).repr1(nested, 2)) <= 4 * 1024)
+
+    def test_report_size_budget(self):
+        import sys
+        from common.utils import format_frame_locals
+
+        def fail():
+            big = ['y' * 100] * 100
+            other = 'z' * 100
+            raise ValueError
+        try:
+            fail()
+        except ValueError:
+            tb = sys.exc_info()[2]
+            frames = []
+            while tb:
+                frames.append(tb.tb_frame)
+                tb = tb.tb_next
+        text = format_frame_locals(frames, max_value=200, max_size=10)
+        self.assertTrue('REPORT SIZE LIMIT' in text)
+
+
+class IterJSONTest(TestCase):
+    def test_streams_iterables(self):
+        import datetime, json
+        from decimal import Decimal
+        from django.contrib.auth.models import User
+        from common.utils import iter_json
+
+        context = {
+            'rows': (dict(id=i, amount=Decimal('1.50')) for i in range(3)),
+            'users': User.objects.values_list('id', flat=True),
+            'day': datetime.date(2012, 1, 1),
+        }
+        pieces = list(iter_json(context, chunk_size=10))
+        self.assertTrue(len(pieces) > 1)
+        self.assertEqual(json.loads(''.join(pieces)), {
+            'rows': [{'id': i, 'amount': '1.50'} for i in range(3)],
+            'users': [],
+            'day': '2012-01-01',
+        })
+
+    def test_deeply_nested_instances(self):
+        import json
+        from common.utils import iter_json
+
+        gadget = Gadget.objects.create(name='nested', code='n1')
+        decoded = json.loads(''.join(iter_json([{'rows': [gadget]}])))
+        self.assertEqual(decoded[0]['rows'][0]['code'], 'n1')
+
+
+class JSONConditionalGetTest(TestCase):
+    def get_view(self, **headers):
+        from django.test.client import RequestFactory
+        from common.views import JSONResponseMixin
+
+        view = JSONResponseMixin()
+        view.request = RequestFactory().get('/data/', **headers)
+        return view
+
+    def test_strong_etag(self):
+        response = self.get_view().render_to_response({'a': 1})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.get_view(HTTP_IF_NONE_MATCH=etag).render_to_response({'a': 1})
+        self.assertEqual(response.status_code, 304)
+        response = self.get_view(HTTP_IF_NONE_MATCH=etag).render_to_response({'a': 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_version_skips_serialization(self):
+        view = self.get_view()
+        view.get_json_version = lambda context: 7
+        etag = view.render_to_response({'a': 1})['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        view = self.get_view(HTTP_IF_NONE_MATCH=etag)
+        view.get_json_version = lambda context: 7
+        view.convert_context_to_json = None
+        self.assertEqual(view.render_to_response({'a': 1}).status_code, 304)
+
+
+def _csv_test_mapper(row):
+    if not row[1].isdigit():
+        raise ValueError('bad count %r' % row[1])
+    return {'name': row[0], 'count': int(row[1])}
+
+
+class ParseCsvTest(TestCase):
+    def test_batches_and_errors(self):
+        import os
+        import tempfile
+        from common.utils import parse_csv
+
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            f.write('name,count\n a ,1\nb,x\n"c",3\n')
+        try:
+            for processes in (1, 2):
+                batches = list(parse_csv(path, _csv_test_mapper, batch_size=2,
+                                         processes=processes, skip_header=True))
+                self.assertEqual(batches, [
+                    ([{'name': u'a', 'count': 1}], [(3, "bad count u'x'")]),
+                    ([{'name': u'c', 'count': 3}], []),
+                ])
+        finally:
+            os.remove(path)
+
+
+class IterCsvTest(TestCase):
+    def test_export(self):
+        import datetime
+        from django.contrib.auth.models import User
+        from common.utils import iter_csv
+
+        for i in range(3):
+            User.objects.create(username=u'user%d' % i, email=u'\xe9%d@example.com' % i,
+                                date_joined=datetime.datetime(2012, 1, 1, 10, 0, 0, 500))
+        qs = User.objects.filter(username__startswith='user')
+        fields = ['username', 'email', 'date_joined']
+        expected = ('username,email,date_joined\r\n' + ''.join(
+            'user%d,\xc3\xa9%d@example.com,2012-01-01 10:00:00\r\n' % (i, i) for i in range(3)))
+
+        self.assertEqual(''.join(iter_csv(qs.order_by('pk'), fields=fields, chunk_size=2)), expected)
+        self.assertEqual(''.join(iter_csv(qs, fields=fields, chunk_size=2, keyset=True)), expected)
+
+
+class KeysetPaginatorTest(TestCase):
+    def test_walk_forward_and_back(self):
+        import datetime
+        from django.contrib.auth.models import User
+        from django.core.paginator import InvalidPage
+        from common.utils import KeysetPaginator
+
+        # pairs of users share a timestamp to exercise the pk tie-break
+        for i in range(7):
+            User.objects.create(username='user%d' % i,
+                                date_joined=datetime.datetime(2012, 1, 1 + i / 2, 12, 0, 0, 250))
+        expected = list(User.objects.order_by('-date_joined', '-pk'))
+        paginator = KeysetPaginator(User.objects.all(), 3, field='date_joined')
+
+        pages, page = [], paginator.page()
+        while True:
+            pages.append(page)
+            if not page.has_next():
+                break
+            page = paginator.page(page.next_cursor)
+        self.assertEqual([obj for page in pages for obj in page], expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous())
+
+        previous = paginator.page(pages[2].previous_cursor)
+        self.assertEqual(previous.object_list, pages[1].object_list)
+        self.assertTrue(previous.has_previous())
+        self.assertRaises(InvalidPage, paginator.page, 'garbage')
+
+
+class ChangeFeedTest(TestCase):
+    def test_checkpointed_pulls(self):
+        import datetime
+        from django.contrib.auth.models import User
+        from common.models import ChangeFeed, ChangeFeedCheckpoint
+
+        # pairs of users share a timestamp to exercise the pk tie-break
+        for i in range(5):
+            User.objects.create(username='user%d' % i,
+                                date_joined=datetime.datetime(2012, 1, 1 + i / 2))
+        expected = list(User.objects.order_by('date_joined', 'pk'))
+
+        feed = ChangeFeed(User, consumer='export', chunk_size=2, field='date_joined')
+        self.assertEqual([len(chunk) for chunk in feed], [2, 2, 1])
+        self.assertEqual([obj for chunk in feed.iter_chunks() for obj in chunk], expected)
+
+        checkpoint = ChangeFeedCheckpoint.objects.get(consumer='export')
+        self.assertEqual(checkpoint.object_pk, unicode(expected[-1].pk))
+        self.assertEqual(list(feed), [])
+
+        late = User.objects.create(username='late', date_joined=expected[-1].date_joined)
+        self.assertEqual(list(feed), [[late]])
+
+
+class ReadOnlyRowTest(TestCase):
+    def test_rows(self):
+        from django.contrib.auth.models import User
+        from common.models import readonly_queryset
+
+        user = User.objects.create(username='reader', email='reader@example.com')
+        rows = list(readonly_queryset(User.objects.filter(username='reader')))
+        self.assertEqual(len(rows), 1)
+
+        row = rows[0]
+        self.assertEqual((row.pk, row.id, row.username, row.email),
+                         (user.pk, user.pk, 'reader', 'reader@example.com'))
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertRaises(AttributeError, setattr, row, 'username', 'writer')
+        self.assertRaises(TypeError, row.save)
+        self.assertRaises(TypeError, row.delete)
+
+
+def _write_email_templates(name, html, css='.greeting { color: red; }'):
+    import os
+    import tempfile
+
+    template_dir = tempfile.mkdtemp()
+    templates = {
+        '%s.subj.txt' % name: 'Hello {{ name }}',
+        '%s.body.txt' % name: 'Hi {{ name }}',
+        '%s.body.html' % name: html,
+        '%s.css' % name: css,
+    }
+    for file_name, content in templates.items():
+        with open(os.path.join(template_dir, file_name), 'w') as f:
+            f.write(content)
+    return template_dir
+
+
+class SendHtmlEmailsTest(TestCase):
+    def test_counts_and_failures(self):
+        import shutil
+        from django.core import mail
+        from django.test.utils import override_settings
+        from common.utils import send_html_emails
+
+        template_dir = _write_email_templates('bulk_test', '<p class="greeting">Hi {{ name }}</p>')
+
+        contexts = [
+            {'email': 'a@example.com', 'name': 'A'},
+            # a newline in the subject makes building this message fail
+            {'email': 'b@example.com', 'name': 'B\nB'},
+            {'email': ['c@example.com', 'd@example.com'], 'name': 'C'},
+            {'name': 'No address'},
+        ]
+        try:
+            with override_settings(TEMPLATE_DIRS=(template_dir,),
+                                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                results = send_html_emails('bulk_test', contexts, from_email='from@example.com',
+                                           batch_size=4, workers=2, precompile=False)
+        finally:
+            shutil.rmtree(template_dir)
+
+        self.assertEqual(results['sent'], 2)
+        self.assertEqual(sorted(to for to, exc in results['failed']), [None, ['b@example.com']])
+        self.assertEqual(sorted(message.to for message in mail.outbox),
+                         [['a@example.com'], ['c@example.com', 'd@example.com']])
+        self.assertTrue('color: red' in mail.outbox[0].alternatives[0][0])
+
+
+class BulkSaveTest(TestCase):
+    def test_insert_update_and_timestamps(self):
+        gadgets = [Gadget(name='g%d' % i, code='c%d' % i) for i in range(600)]
+        inserted, updated = Gadget.objects.bulk_save(gadgets)
+        self.assertEqual((len(inserted), len(updated)), (600, 0))
+        self.assertEqual(Gadget.objects.count(), 600)
+
+        saved = list(Gadget.objects.order_by('pk'))
+        before = saved[0].date_updated
+        for gadget in saved:
+            gadget.kind = 'k'
+        inserted, updated = Gadget.objects.bulk_save(saved, fields=['kind'])
+        self.assertEqual((len(inserted), len(updated)), (0, 600))
+
+        self.assertEqual(Gadget.objects.filter(kind='k').count(), 600)
+        self.assertFalse(Gadget.objects.filter(date_updated=before).exists())
+
+    def test_bulk_update(self):
+        from common.utils import bulk_update, query_batch_size
+
+        users = [User.objects.create(username='bulk%d' % i) for i in range(5)]
+        for user in users:
+            user.first_name = 'First %s' % user.pk
+        with self.assertNumQueries(3):
+            bulk_update(User, users, fields=['first_name'], batch_size=2)
+        self.assertEqual(sorted(User.objects.filter(username__startswith='bulk')
+                                .values_list('first_name', flat=True)),
+                         sorted('First %s' % user.pk for user in users))
+        self.assertTrue(query_batch_size('default', 1000, 500) >= 1)
+
+    def test_default_manager(self):
+        from common.models import BaseManager
+
+        # Base.objects is only the default when a subclass declares no manager
+        self.assertTrue(Sprocket._default_manager is Sprocket.active)
+        self.assertTrue(isinstance(Gadget._default_manager, BaseManager))
+        self.assertTrue(Gadget._default_manager is Gadget.objects)
+
+
+class DirtyFieldsTest(TestCase):
+    def test_dirty_tracking(self):
+        gadget = Gadget.objects.create(name='tracked', code='t1')
+        self.assertEqual(gadget.get_dirty_fields(), {})
+
+        gadget.name = 'renamed'
+        gadget.kind = ''
+        self.assertEqual(gadget.get_dirty_fields(), {'name': 'tracked'})
+        self.assertTrue(gadget.has_changed('name'))
+        self.assertFalse(gadget.has_changed('kind'))
+
+        gadget.save()
+        self.assertFalse(gadget.has_changed('name'))
+
+    def test_dirty_only_save(self):
+        from django.db.models.signals import post_save
+
+        gadget = Gadget.objects.create(name='partial', code='p1')
+        with self.assertNumQueries(0):
+            gadget.save(dirty_only=True)
+
+        # an explicit pk doesn't make a new instance saved already
+        Gadget(pk=gadget.pk + 100, name='explicit', code='p0').save(dirty_only=True)
+        self.assertTrue(Gadget.objects.filter(pk=gadget.pk + 100).exists())
+
+        # a concurrent writer's column survives an UPDATE of the other one
+        other = Gadget.objects.get(pk=gadget.pk)
+        other.kind = 'elsewhere'
+        other.save(dirty_only=True, skip_validation=True)
+
+        saved = []
+        def record(sender, instance, created, **kwargs):
+            saved.append((instance.pk, created))
+        post_save.connect(record, sender=Gadget)
+        try:
+            gadget.name = 'partial2'
+            gadget.save(dirty_only=True, skip_validation=True)
+        finally:
+            post_save.disconnect(record, sender=Gadget)
+
+        self.assertEqual(saved, [(gadget.pk, False)])
+        reloaded = Gadget.objects.get(pk=gadget.pk)
+        self.assertEqual((reloaded.name, reloaded.kind), ('partial2', 'elsewhere'))
+
+    def test_json_changed_in_place(self):
+        gadget = Gadget.objects.create(name='json', code='j1', data={'a': 1})
+        gadget = Gadget.objects.get(pk=gadget.pk)
+        self.assertEqual(gadget.get_dirty_fields(), {})
+
+        # parsing alone is not a change
+        self.assertEqual(gadget.data, {'a': 1})
+        self.assertFalse(gadget.has_changed('data'))
+        with self.assertNumQueries(0):
+            gadget.save(dirty_only=True)
+
+        gadget.data['a'] = 2
+        self.assertTrue(gadget.has_changed('data'))
+        gadget.save(dirty_only=True, skip_validation=True)
+        self.assertFalse(gadget.has_changed('data'))
+        self.assertEqual(Gadget.objects.get(pk=gadget.pk).data, {'a': 2})
+
+
+class LazyJSONFieldTest(TestCase):
+    def test_parse_on_access_only(self):
+        from common.fields import RawJSON
+
+        raw = '{"b": 1,   "a": [1, 2]}'
+        gadget = Gadget.objects.create(name='lazy', code='l1')
+        Gadget.objects.filter(pk=gadget.pk).update(data=raw)
+
+        gadget = Gadget.objects.get(pk=gadget.pk)
+        self.assertTrue(isinstance(gadget.__dict__['data'], RawJSON))
+
+        # a validated save neither parses nor re-serializes the value
+        gadget.name = 'lazy2'
+        gadget.save()
+        self.assertTrue(isinstance(gadget.__dict__['data'], RawJSON))
+        self.assertEqual(Gadget.objects.filter(pk=gadget.pk).values_list('data', flat=True)[0], raw)
+
+        data = gadget.data
+        self.assertEqual(data, {'b': 1, 'a': [1, 2]})
+        self.assertTrue(gadget.data is data)
+
+
+class InlinedTemplateTest(TestCase):
+    def test_precompiled_matches_per_render(self):
+        import os
+        import time
+        import shutil
+        from django.test.utils import override_settings
+        from common.utils import get_inlined_template, render_html_email
+
+        html = ('<div><p class="greeting">Hi {{ name }}</p><p>{{ note }}</p>'
+                '<a href="{{ url }}">link</a></div>')
+        template_dir = _write_email_templates('inline_test', html)
+        unsafe_dir = _write_email_templates('unsafe_test', '<div>{{ body|safe }}</div>')
+        class_dir = _write_email_templates('class_test', '<p class="{{ kind }}">Hi</p>')
+        try:
+            with override_settings(TEMPLATE_DIRS=(template_dir, unsafe_dir, class_dir)):
+                context = {'name': 'Ann & Bob', 'note': '<b>escaped</b>', 'url': 'http://example.com/offers/'}
+                self.assertEqual(render_html_email('inline_test', context, precompile=True),
+                                 render_html_email('inline_test', context, precompile=False))
+                template = get_inlined_template('inline_test')
+                self.assertTrue(template is not None)
+                self.assertTrue(get_inlined_template('inline_test') is template)
+                # injected markup and templated classes have to be styled per render
+                self.assertTrue(get_inlined_template('unsafe_test') is None)
+                self.assertTrue(get_inlined_template('class_test') is None)
+
+                # an edited stylesheet is picked up
+                css_path = os.path.join(template_dir, 'inline_test.css')
+                with open(css_path, 'w') as f:
+                    f.write('.greeting { color: blue; }')
+                os.utime(css_path, (time.time() + 10, time.time() + 10))
+                self.assertTrue('color: blue' in render_html_email('inline_test', context, precompile=True)[2])
+        finally:
+            for path in (template_dir, unsafe_dir, class_dir):
+                shutil.rmtree(path)
+
+
+class FullReverseTest(TestCase):
+    urls = 'common.tests'
+
+    def test_memoized_per_language(self):
+        from django.contrib.sites.models import Site
+        from django.utils import translation
+        from common.utils import _full_reverse_cache, full_reverse
+
+        _full_reverse_cache.clear()
+        url = full_reverse('common-test-gadget', args=[1], rewrite_domain='example.com', use_ssl=False)
+        self.assertEqual(url, 'http://example.com/gadgets/1/')
+        self.assertEqual(full_reverse('common-test-gadget', args=[1], rewrite_domain='example.com',
+                                      use_ssl=True), 'https://example.com/gadgets/1/')
+        full_reverse('common-test-gadget', args=[1], rewrite_domain='example.com', use_ssl=False)
+        self.assertEqual(_full_reverse_cache.info()['hits'], 1)
+
+        translation.activate('de')
+        try:
+            full_reverse('common-test-gadget', args=[1], rewrite_domain='example.com', use_ssl=False)
+        finally:
+            translation.deactivate()
+        self.assertEqual(_full_reverse_cache.info()['size'], 3)
+
+        # the usual kwargs= form is memoized too
+        for i in range(2):
+            self.assertEqual(full_reverse('common-test-gadget-slug', kwargs={'slug': 'abc'},
+                                          rewrite_domain='example.com', use_ssl=False),
+                             'http://example.com/gadgets/abc/')
+        self.assertEqual(_full_reverse_cache.info()['hits'], 2)
+        self.assertEqual(_full_reverse_cache.info()['size'], 4)
+
+        Site.objects.get_current().save()
+        self.assertEqual(_full_reverse_cache.info()['size'], 0)
+
+
+class BulkCreateOrUpdateTest(TestCase):
+    def test_status_codes(self):
+        from common.utils import bulk_create_or_update
+
+        User.objects.create(username='same', first_name='Same')
+        User.objects.create(username='changed', first_name='Old')
+
+        results = bulk_create_or_update(User, [
+            {'username': 'new', 'first_name': 'A'},
+            {'username': 'same', 'first_name': 'Same'},
+            {'username': 'changed', 'first_name': 'New'},
+            # the same new key twice: created once, then updated
+            {'username': 'new', 'first_name': 'B'},
+        ], key_fields=['username'])
+
+        self.assertEqual([status for status, obj in results], [2, 0, 1, 1])
+        self.assertTrue(all(obj.pk is not None for status, obj in results))
+        self.assertTrue(results[0][1] is results[3][1])
+        self.assertEqual(User.objects.get(username='new').first_name, 'B')
+        self.assertEqual(User.objects.get(username='changed').first_name, 'New')
+        self.assertEqual(User.objects.filter(username='new').count(), 1)
+
+
+class ForeignKeyValidationTest(TestCase):
+    def test_grouped_queries_and_cache(self):
+        from django.db import close_connection
+        from django.core.signals import request_finished
+        from common.fields import _fk_validation_cache, fk_validation_cache, validate_foreign_keys
+        from common.middleware import FKValidationCacheMiddleware
+
+        staff = User.objects.create(username='staff', is_staff=True)
+        user = User.objects.create(username='plain')
+        gadgets = [
+            Gadget(name='a', code='a', owner=user, reviewer=staff),
+            Gadget(name='b', code='b', owner=staff, reviewer=user),
+            Gadget(name='c', code='c', owner_id=user.pk + staff.pk + 100),
+        ]
+
+        with fk_validation_cache() as known:
+            # owner and reviewer differ in limit_choices_to, so one query each
+            with self.assertNumQueries(2):
+                errors = validate_foreign_keys(gadgets)
+            self.assertEqual(sorted(errors), [1, 2])
+            self.assertEqual(errors[1].keys(), ['reviewer'])
+            self.assertEqual(errors[2].keys(), ['owner'])
+
+            with self.assertNumQueries(0):
+                gadgets[0]._meta.get_field('owner').validate(user.pk, gadgets[0])
+            self.assertEqual(len(known), 3)
+        self.assertTrue(_fk_validation_cache() is None)
+
+        # a cache leaked by an aborted request is dropped by the next one
+        middleware = FKValidationCacheMiddleware()
+        class Request(object):
+            pass
+        leaked = Request()
+        middleware.process_request(leaked)
+        _fk_validation_cache().add('stale')
+        middleware.process_request(Request())
+        self.assertEqual(_fk_validation_cache(), set())
+        # as the test client does, keep the test's connection open
+        request_finished.disconnect(close_connection)
+        try:
+            request_finished.send(sender=self.__class__)
+        finally:
+            request_finished.connect(close_connection)
+        self.assertTrue(_fk_validation_cache() is None)
+
+    def test_string_values_and_bulk_save_errors(self):
+        from django.core.exceptions import ValidationError
+        from common.fields import fk_validation_cache, validate_foreign_keys
+
+        user = User.objects.create(username='owner')
+        gadget = Gadget(name='s', code='s', owner_id=str(user.pk))
+        with fk_validation_cache():
+            self.assertEqual(validate_foreign_keys([gadget]), {})
+            with self.assertNumQueries(0):
+                gadget._meta.get_field('owner').validate(str(user.pk), gadget)
+
+        # the missing owner is reported once, by validate_foreign_keys
+        missing = Gadget(name='m', code='m', owner_id=user.pk + 100)
+        try:
+            Gadget.objects.bulk_save([gadget, missing])
+        except ValidationError, exc:
+            self.assertEqual(exc.message_dict.keys(), [1])
+            self.assertEqual(len(exc.message_dict[1]), 1)
+        else:
+            self.fail('ValidationError not raised')
+        self.assertFalse(Gadget.objects.exists())
+
+
+class LastLoginRecorderTest(TestCase):
+    def test_batched_flush(self):
+        import datetime
+        from django.core.cache import cache
+        from common.middleware import LastLoginRecorder
+        from common.models import user_cache_key
+
+        old = datetime.datetime(2012, 1, 1)
+        users = [User.objects.create(username='login%d' % i, last_login=old) for i in range(3)]
+        recorder = LastLoginRecorder(interval=0, batch_size=3, flush_interval=60)
+
+        with self.assertNumQueries(0):
+            recorder.touch(users[0])
+            recorder.touch(users[1])
+        # an idle process still writes the partial batch when the timer fires
+        self.assertTrue(recorder.timer is not None)
+        self.assertEqual(User.objects.filter(pk__in=[u.pk for u in users], last_login=old).count(), 3)
+
+        cache.set(user_cache_key(users[0].pk), users[0])
+        with self.assertNumQueries(1):
+            recorder.touch(users[2])
+        self.assertTrue(recorder.timer is None)
+        self.assertEqual(User.objects.filter(pk__in=[u.pk for u in users], last_login=old).count(), 0)
+        # cached users are kept, with a possibly older last_login
+        self.assertEqual(cache.get(user_cache_key(users[0].pk)), users[0])
+
+
+class IncrementalValidationTest(TestCase):
+    def test_only_dirty_fields_validated(self):
+        from django.core.exceptions import ValidationError
+
+        Gadget.objects.create(name='taken', kind='x', code='v1')
+        gadget = Gadget.objects.create(name='taken', kind='y', code='v2')
+
+        gadget.kind = 'z'
+        # unique_together (name, kind) is checked, the unchanged unique code is
+        # not: one uniqueness query, then Django's SELECT and UPDATE
+        with self.assertNumQueries(3):
+            gadget.save(incremental_validation=True)
+        self.assertTrue('code' in gadget.skipped_validation)
+        self.assertFalse('name' in gadget.skipped_validation)
+
+        gadget.kind = 'x'
+        self.assertRaises(ValidationError, gadget.save, incremental_validation=True)
+
+        gadget.kind = 'w'
+        gadget.save(skip_validation=True)
+        self.assertTrue('kind' in gadget.skipped_validation)
+        gadget.save()
+        self.assertEqual(gadget.skipped_validation, [])
+
+    def test_new_instances_validated_fully(self):
+        from django.core.exceptions import ValidationError
+
+        Gadget.objects.create(name='first', code='dup')
+        # an explicit pk doesn't turn a create into an incremental save
+        gadget = Gadget(pk=1000, name='second', code='dup')
+        self.assertRaises(ValidationError, gadget.save, incremental_validation=True)
+        self.assertFalse(Gadget.objects.filter(pk=1000).exists())
+
+
+class ChangedFieldsFeedTest(TestCase):
+    def test_fields_since_the_feed_mark(self):
+        from common.models import ChangeFeed
+
+        gadgets = [Gadget.objects.create(name='feed%d' % i, code='f%d' % i) for i in range(3)]
+        feed = ChangeFeed(Gadget, consumer='sync', chunk_size=1, include_fields=True)
+        list(feed)
+
+        Gadget.track_changed_fields = True
+        try:
+            gadgets[0].name = 'renamed'
+            gadgets[0].save()
+            gadgets[1].kind = 'k'
+            gadgets[1].save()
+            gadgets[0].kind = 'k'
+            gadgets[0].save()
+        finally:
+            Gadget.track_changed_fields = False
+
+        chunks = list(feed)
+        self.assertEqual([[obj.pk for obj in chunk] for chunk in chunks],
+                         [[gadgets[1].pk], [gadgets[0].pk]])
+        self.assertEqual(chunks[0][0].changed_fields, ['kind'])
+        # the rename happened before the end of the first chunk
+        self.assertEqual(chunks[1][0].changed_fields, ['kind', 'name'])
+
+
+def _gadget_csv_mapper(row):
+    return {'name': row[0], 'code': row[1]}
+
+
+class ImportCsvTest(TransactionTestCase):
+    def test_batches_are_atomic(self):
+        import os
+        import tempfile
+        from common.utils import import_csv
+
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            # the first batch takes two INSERTs on SQLite and the second one
+            # fails on a duplicate code, so the first must be undone too
+            for i in range(150):
+                f.write('first%d,a%d\n' % (i, i))
+            f.write('dup,a0\n')
+            for i in range(10):
+                f.write('second%d,b%d\n' % (i, i))
+        try:
+            stats = import_csv(path, Gadget, _gadget_csv_mapper, batch_size=151, processes=1)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(stats['rows'], 161)
+        self.assertEqual(stats['imported'], 10)
+        self.assertEqual([line for line, message in stats['errors']], [1])
+        self.assertEqual(Gadget.objects.count(), 10)
+
+
+class CachedUserTest(TestCase):
+    def test_lazy_cached_user(self):
+        from django.core.cache import cache
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+        from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY
+        from common.middleware import AuthenticationMiddleware
+        from common.models import user_cache_key
+
+        user = User.objects.create(username='cached')
+        cache.delete(user_cache_key(user.pk))
+        middleware = AuthenticationMiddleware()
+
+        def make_request():
+            request = RequestFactory().get('/')
+            request.session = {SESSION_KEY: user.pk,
+                               BACKEND_SESSION_KEY: 'django.contrib.auth.backends.ModelBackend'}
+            with self.assertNumQueries(0):
+                middleware.process_request(request)
+            return request
+
+        with override_settings(AUTH_USER_CACHE_TIMEOUT=60):
+            # looked up on first use, then served from the cache
+            request = make_request()
+            with self.assertNumQueries(1):
+                self.assertEqual(request.user.pk, user.pk)
+            request = make_request()
+            with self.assertNumQueries(0):
+                self.assertEqual(request.user.pk, user.pk)
+
+            # saving the user drops the cached copy
+            user.first_name = 'Changed'
+            user.save()
+            request = make_request()
+            with self.assertNumQueries(1):
+                self.assertEqual(request.user.first_name, 'Changed')
+
+
+class NormalizePhoneNumbersTest(TestCase):
+    def setUp(self):
+        import datetime
+        from django.db import connection
+
+        # PhoneNumberField normalizes on save, so write legacy values directly
+        qn = connection.ops.quote_name
+        now = datetime.datetime.now()
+        cursor = connection.cursor()
+        for pk, phone, fax in [(1, '(415) 555-0100', '+14155550101'),
+                               (2, 'not a number', ''),
+                               (3, '+14155550102', 'garbage'),
+                               (4, '', '415.555.0103')]:
+            cursor.execute('INSERT INTO %s (%s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s)' % (
+                qn(Contact._meta.db_table), qn('id'), qn('date_created'), qn('date_updated'),
+                qn('phone'), qn('fax')), [pk, now, now, phone, fax])
+
+    def stored(self):
+        return list(Contact.objects.order_by('pk').values_list('phone', 'fax'))
+
+    def test_dry_run_reports_unparseable(self):
+        from common.utils import normalize_phone_numbers
+
+        before = self.stored()
+        stats = normalize_phone_numbers(Contact, processes=1, dry_run=True)
+        self.assertEqual((stats['rows'], stats['updated'], stats['last_pk']), (4, 2, 4))
+        self.assertEqual(sorted(stats['unparseable']),
+                         [(2, 'phone', 'not a number'), (3, 'fax', 'garbage')])
+        self.assertEqual(self.stored(), before)
+
+    def test_only_changed_columns_are_rewritten(self):
+        from common.utils import normalize_phone_numbers
+
+        normalize_phone_numbers(Contact, processes=1)
+        self.assertEqual(self.stored(), [
+            ('+14155550100', '+14155550101'),
+            ('not a number', ''),
+            ('+14155550102', 'garbage'),
+            ('', '+14155550103'),
+        ])
+
+    def test_resume_from_start_pk(self):
+        from common.utils import normalize_phone_numbers
+
+        checkpoints = []
+        stats = normalize_phone_numbers(Contact, chunk_size=1, processes=1, start_pk=1,
+                                        on_chunk=lambda stats: checkpoints.append(stats['last_pk']))
+        self.assertEqual(checkpoints, [2, 3, 4])
+        self.assertEqual((stats['rows'], stats['updated']), (3, 1))
+        self.assertEqual(self.stored()[0], ('(415) 555-0100', '+14155550101'))
+        self.assertEqual(self.stored()[3], ('', '+14155550103'))
@@ -1,12 +1,22 @@
 import re
 import csv
 import json
+import time
+import Queue
 import datetime
+import threading
 from decimal import Decimal
+from repr import Repr as ReprBase
 
 from django.conf import settings
-from django.template import loader
+from django.template import loader, Context, Template
+from django.core import signing
 from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.utils.functional import lazy
+from django.db import connections, models, router, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 from django.core.mail import mail_admins, EmailMultiAlternatives
@@ -16,26 +26,222 @@ from django.core.mail import mail_admins, EmailMultiAlternatives
 Wrapper around csv reader that ignores non utf-8 chars and strips the record
 """
 class CsvReader(object):
-    def __init__(self, file_name, delimiter=','):
+    def __init__(self, file_name, delimiter=',', clean=True):
         self.reader = csv.reader(open(file_name, 'rbU'), delimiter=delimiter)
+        self.clean = clean
  
     def __iter__(self):
         return self
 
     def next(self):
         row = self.reader.next()       
-        row = [el.decode('utf8', errors='ignore').replace('\"', '').strip() for el in row]
+        if self.clean:
+            row = self.clean_row(row)
         return row
 
+    @staticmethod
+    def clean_row(row):
+        return [el.decode('utf8', errors='ignore').replace('\"', '').strip() for el in row]
 
-def mail_exception(subject=None, context=None, vars=True):
-    import traceback, sys
+
+def format_csv_value(value):
+    """Format a value for CSV output with the same rules as Encoder"""
+    if value is None:
+        return ''
+    if isinstance(value, (Decimal, datetime.date)):
+        return encode_default(value)
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+class _CsvBuffer(object):
+    """File-like object that hands back what csv.writer wrote to it"""
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def pop(self):
+        data = ''.join(self.lines)
+        self.lines = []
+        return data
+
+
+# Stream a queryset as CSV bytes, one chunk of `chunk_size` rows at a time.
+# Columns are read with values_list(*fields) (every concrete field by default),
+# so no model instances are built. Rows are read with iterator(), or with
+# keyset=True in pk order, `chunk_size` rows per query, which keeps memory flat
+# even on backends whose cursors fetch the whole result set.
+def iter_csv(queryset, fields=None, header=True, chunk_size=1000, keyset=False, delimiter=','):
+    if not fields:
+        fields = [f.attname for f in queryset.model._meta.fields]
+
+    buf = _CsvBuffer()
+    writer = csv.writer(buf, delimiter=delimiter)
+    if header:
+        writer.writerow([format_csv_value(name) for name in fields])
+        yield buf.pop()
+
+    if keyset:
+        def rows():
+            # pk is fetched last so it can be dropped from what gets written
+            qs = queryset.order_by('pk').values_list(*(list(fields) + ['pk']))
+            last_pk = None
+            while True:
+                page = qs.filter(pk__gt=last_pk) if last_pk is not None else qs
+                page = list(page[:chunk_size])
+                if not page:
+                    break
+                for row in page:
+                    yield row[:-1]
+                last_pk = page[-1][-1]
+        rows = rows()
+    else:
+        rows = queryset.values_list(*fields).iterator()
+
+    for batch in chunks(rows, chunk_size):
+        writer.writerows([format_csv_value(value) for value in row] for row in batch)
+        yield buf.pop()
+
+
+def write_csv(queryset, file_obj, **kwargs):
+    """Write iter_csv() output to a file object; takes the same arguments"""
+    for data in iter_csv(queryset, **kwargs):
+        file_obj.write(data)
+
+
+# Read a CSV file in batches of `batch_size` rows and turn each row into a
+# dict of model attrs with mapper(row), a module level function so it can be
+# sent to the worker processes (processes=1 keeps everything in-process). Rows
+# are cleaned like CsvReader does and, given model_class, validated with
+# clean_fields() (relations excluded, so workers never touch the database).
+# At most `max_pending` batches are in flight, which bounds memory however
+# large the file is. Yields (records, errors) per batch in file order, with
+# errors as (line number, message) tuples.
+def parse_csv(file_name, mapper, model_class=None, batch_size=1000, processes=None,
+              delimiter=',', skip_header=False, max_pending=None):
+    from collections import deque
+    from multiprocessing import Pool, cpu_count
+
+    reader = CsvReader(file_name, delimiter, clean=False)
+    first_line = 1
+    if skip_header:
+        next(reader, None)
+        first_line = 2
+
+    processes = processes or cpu_count()
+    max_pending = max_pending or processes * 2
+    batches = ((mapper, model_class, first_line + idx * batch_size, rows)
+               for idx, rows in enumerate(chunks(reader, batch_size)))
+
+    if processes <= 1:
+        for batch in batches:
+            yield _parse_csv_batch(batch)
+        return
+
+    pool = Pool(processes)
+    pending = deque()
+    try:
+        for batch in batches:
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_parse_csv_batch, (batch,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_csv_batch(batch):
+    mapper, model_class, first_line, rows = batch
+    if model_class is not None:
+        exclude = [f.name for f in model_class._meta.fields if f.rel or f.primary_key]
+
+    records, errors = [], []
+    for line, row in enumerate(rows, first_line):
+        try:
+            attrs = mapper(CsvReader.clean_row(row))
+            if model_class is not None:
+                model_class(**attrs).clean_fields(exclude=exclude)
+        except Exception, exc:
+            errors.append((line, getattr(exc, 'message_dict', None) or unicode(exc)))
+            continue
+        records.append(attrs)
+    return records, errors
+
+
+# Load a CSV file into model_class through parse_csv(). Batches are written
+# with bulk_create() (bulk_save() for Base models, for the timestamps), or
+# upserted with bulk_create_or_update() when key_fields are given. Rows are
+# validated once, by parse_csv(). A batch that fails to write (including model
+# validation the workers skip, such as foreign keys) is reported as an error on
+# its first line and rolled back as a whole.
+# Returns {'rows', 'imported', 'errors', 'seconds', 'rows_per_second'}.
+def import_csv(file_name, model_class, mapper, key_fields=None, batch_size=1000, processes=None,
+               delimiter=',', skip_header=False, max_pending=None):
+    from django.db import DatabaseError
+    from django.core.exceptions import ValidationError
+
+    started = time.time()
+    manager = model_class.objects
+    stats = {'rows': 0, 'imported': 0, 'errors': []}
+    line = skip_header and 2 or 1
+
+    for records, errors in parse_csv(file_name, mapper, model_class, batch_size, processes,
+                                     delimiter, skip_header, max_pending):
+        stats['rows'] += len(records) + len(errors)
+        stats['errors'].extend(errors)
+        try:
+            # bulk_create() and bulk_update() commit on their own outside a
+            # managed transaction, and a batch may take several of them
+            with transaction.commit_on_success(using=manager.db):
+                if key_fields:
+                    bulk_create_or_update(model_class, records, key_fields, batch_size=batch_size,
+                                          skip_validation=True)
+                elif hasattr(manager, 'bulk_save'):
+                    manager.bulk_save([model_class(**attrs) for attrs in records],
+                                      batch_size=batch_size, skip_validation=True)
+                else:
+                    manager.bulk_create([model_class(**attrs) for attrs in records])
+        except (DatabaseError, ValidationError), exc:
+            stats['errors'].append((line, 'batch of %d rows not written: %s' % (len(records), exc)))
+        else:
+            stats['imported'] += len(records)
+        line += len(records) + len(errors)
+
+    stats['seconds'] = time.time() - started
+    stats['rows_per_second'] = stats['rows'] / max(stats['seconds'], 1e-6)
+    return stats
+
+
+def mail_exception(subject=None, context=None, vars=True, background=False):
+    import sys
 
     exc_info = sys.exc_info()
 
+    if background:
+        get_exception_reporter().report(subject, context, vars, exc_info=exc_info)
+        return
+
     if not subject:
         subject = exc_info[1].__class__.__name__
 
+    message = exception_message(exc_info, context, vars)
+
+    if settings.DEBUG:
+        print subject
+        print
+        print message
+    else:
+        mail_admins(subject, message, fail_silently=True)
+
+
+def exception_message(exc_info, context=None, vars=True):
+    import traceback
+
     message = ''
 
     if context:
@@ -55,33 +261,230 @@ def mail_exception(subject=None, context=None, vars=True):
             stack.append(tb.tb_frame)
             tb = tb.tb_next
 
-        message = "Locals by frame, innermost last:\n"
-
-        for frame in stack:
-            message += "\nFrame %s in %s at line %s\n" % (frame.f_code.co_name,
-                                                 frame.f_code.co_filename,
-                                                 frame.f_lineno)
-            for key, value in frame.f_locals.items():
-                message += "\t%16s = " % key
-                # We have to be careful not to cause a new error in our error
-                # printer! Calling repr() on an unknown object could cause an
-                # error we don't want.
-                try:
-                    message += '%s\n' % repr(value)
-                except:
-                    message += "<ERROR WHILE PRINTING VALUE>\n"
+        message += "Locals by frame, innermost last:\n"
+        message += format_frame_locals(stack)
 
 
     message += '\n\n\n%s\n' % (
             '\n'.join(traceback.format_exception(*exc_info)),
         )
 
-    if settings.DEBUG:
-        print subject
-        print
-        print message
-    else:
-        mail_admins(subject, message, fail_silently=True)
+    return message
+
+
+"""
+repr() with reprlib-style truncation that never evaluates QuerySets, lazy
+objects or files. Extra types can be listed as dotted paths in
+settings.EXCEPTION_LOCALS_DENYLIST.
+"""
+class SafeRepr(ReprBase):
+    def __init__(self, max_value=1024):
+        ReprBase.__init__(self)
+        self.max_value = max_value
+        # At most 10 x 10 leaves of a nested container are rendered, each cut
+        # to a small share of max_value, so the text built before the final
+        # cut stays within a few times max_value.
+        self.maxlevel = 2
+        self.maxtuple = self.maxlist = self.maxarray = self.maxset = self.maxfrozenset = 10
+        self.maxdict = 10
+        self.maxstring = self.maxother = max_value
+        self.nested_max = max(20, max_value // 100)
+        self.maxlong = 100
+        self.denylist = self.get_denylist()
+
+    def repr(self, x):
+        text = self.repr1(x, self.maxlevel)
+        if len(text) > self.max_value:
+            text = text[:max(self.max_value - 3, 0)] + '...'
+        return text
+
+    @staticmethod
+    def get_denylist():
+        import io
+        from django.db.models.query import QuerySet
+        from django.utils.functional import LazyObject, Promise
+        from django.utils.importlib import import_module
+
+        denylist = [QuerySet, LazyObject, Promise, file, io.IOBase]
+        for path in getattr(settings, 'EXCEPTION_LOCALS_DENYLIST', ()):
+            module, attr = path.rsplit('.', 1)
+            denylist.append(getattr(import_module(module), attr))
+        return tuple(denylist)
+
+    def repr1(self, x, level):
+        if isinstance(x, self.denylist):
+            return '<%s object at 0x%x (not evaluated)>' % (type(x).__name__, id(x))
+        if level == self.maxlevel:
+            self.maxstring = self.maxother = self.max_value
+        else:
+            self.maxstring = self.maxother = self.nested_max
+        return ReprBase.repr1(self, x, level)
+
+
+# Render the locals of each frame for an error report, within a size budget
+# per value (EXCEPTION_LOCALS_MAX_VALUE characters), per report
+# (EXCEPTION_LOCALS_MAX_SIZE) and in time (EXCEPTION_LOCALS_MAX_MS
+# milliseconds). Whatever doesn't fit is left out with a note.
+def format_frame_locals(stack, max_value=None, max_size=None, max_ms=None):
+    max_value = max_value or getattr(settings, 'EXCEPTION_LOCALS_MAX_VALUE', 1024)
+    max_size = max_size or getattr(settings, 'EXCEPTION_LOCALS_MAX_SIZE', 64 * 1024)
+    max_ms = max_ms or getattr(settings, 'EXCEPTION_LOCALS_MAX_MS', 200)
+
+    safe_repr = SafeRepr(max_value)
+    deadline = time.time() + max_ms / 1000.0
+    lines = []
+    size = 0
+
+    for frame in stack:
+        lines.append("\nFrame %s in %s at line %s\n" % (frame.f_code.co_name,
+                                                      frame.f_code.co_filename,
+                                                      frame.f_lineno))
+        for key, value in frame.f_locals.items():
+            if size > max_size:
+                lines.append("\n<LOCALS TRUNCATED: REPORT SIZE LIMIT OF %d REACHED>\n" % max_size)
+                return ''.join(lines)
+            if time.time() > deadline:
+                lines.append("\n<LOCALS TRUNCATED: TIME LIMIT OF %dMS REACHED>\n" % max_ms)
+                return ''.join(lines)
+
+            # We have to be careful not to cause a new error in our error
+            # printer! Calling repr() on an unknown object could cause an
+            # error we don't want.
+            try:
+                line = "\t%16s = %s\n" % (key, safe_repr.repr(value))
+            except:
+                line = "\t%16s = <ERROR WHILE PRINTING VALUE>\n" % key
+            lines.append(line)
+            size += len(line)
+
+    return ''.join(lines)
+
+
+def exception_fingerprint(exc_info):
+    """Identify an exception by its type and the code locations it went through"""
+    import hashlib
+    import traceback
+
+    location = ['%s:%s:%s' % (filename, lineno, name)
+                for filename, lineno, name, _ in traceback.extract_tb(exc_info[2])]
+    return hashlib.md5('%s|%s' % (exc_info[0].__name__, '|'.join(location))).hexdigest()
+
+
+"""
+Reports exceptions to the admins from a background thread. Reports are
+grouped by exception_fingerprint() and one digest per fingerprint is mailed
+every `window` seconds, with at most `max_emails` mails per window (the rest
+are summarized in one extra mail). Only the first occurrence of a fingerprint
+in a window pays for building the full message; later ones are just counted.
+Reports that don't fit in the bounded queue are dropped and counted. With
+background=False no thread is started and reports wait for flush(), which
+then is the only consumer of the queue.
+"""
+class ExceptionReporter(object):
+    def __init__(self, window=None, max_queue=None, max_emails=None, background=True):
+        self.window = window or getattr(settings, 'EXCEPTION_REPORT_WINDOW', 60)
+        self.max_emails = max_emails or getattr(settings, 'EXCEPTION_REPORT_MAX_EMAILS', 10)
+        self.queue = Queue.Queue(max_queue or getattr(settings, 'EXCEPTION_REPORT_QUEUE_SIZE', 1000))
+        self.lock = threading.Lock()
+        self.described = set()
+        self.digests = {}
+        self.dropped = 0
+        self.background = background
+        self.thread = None
+
+    def report(self, subject=None, context=None, vars=True, exc_info=None):
+        import sys
+
+        exc_info = exc_info or sys.exc_info()
+        fingerprint = exception_fingerprint(exc_info)
+        with self.lock:
+            describe = fingerprint not in self.described
+            self.described.add(fingerprint)
+
+        item = (fingerprint,
+                subject or exc_info[1].__class__.__name__,
+                describe and exception_message(exc_info, context, vars) or None)
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+                if describe:
+                    self.described.discard(fingerprint)
+            return
+
+        if self.background:
+            self._start()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='ExceptionReporter')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        next_send = time.time() + self.window
+        while True:
+            try:
+                self._collect(self.queue.get(timeout=max(0, next_send - time.time())))
+            except Queue.Empty:
+                pass
+            if time.time() >= next_send:
+                self.send_digests()
+                next_send = time.time() + self.window
+
+    def _collect(self, item):
+        fingerprint, subject, message = item
+        with self.lock:
+            digest = self.digests.setdefault(fingerprint, {'subject': subject, 'message': None, 'count': 0})
+            digest['count'] += 1
+            if message and not digest['message']:
+                digest['message'] = message
+
+    def flush(self):
+        """Collect everything queued so far and send the digests right away"""
+        while True:
+            try:
+                self._collect(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        self.send_digests()
+
+    def send_digests(self):
+        from django.core.mail import get_connection
+
+        with self.lock:
+            digests, self.digests = self.digests, {}
+            dropped, self.dropped = self.dropped, 0
+            self.described.clear()
+        if not digests and not dropped:
+            return
+
+        digests = sorted(digests.values(), key=lambda digest: -digest['count'])
+        connection = get_connection(fail_silently=True)
+        for digest in digests[:self.max_emails]:
+            mail_admins('%s (%d times in %ds)' % (digest['subject'], digest['count'], self.window),
+                        digest['message'] or 'Details were sent in an earlier report.',
+                        fail_silently=True, connection=connection)
+
+        overflow = digests[self.max_emails:]
+        if overflow or dropped:
+            lines = ['%5d  %s' % (digest['count'], digest['subject']) for digest in overflow]
+            if dropped:
+                lines.append('%5d  reports dropped because the queue was full' % dropped)
+            mail_admins('%d more exception reports' % (sum(d['count'] for d in overflow) + dropped),
+                        '\n'.join(lines), fail_silently=True, connection=connection)
+
+
+_exception_reporter = None
+
+
+def get_exception_reporter():
+    global _exception_reporter
+    if _exception_reporter is None:
+        _exception_reporter = ExceptionReporter()
+    return _exception_reporter
 
 
 def utctoday():
@@ -109,36 +512,122 @@ def ellipsize(s, length):
         return s[:length-3] + '...'
 
 
+"""
+Small thread-safe LRU cache with hit/miss counters
+"""
+class LRUCache(object):
+    def __init__(self, maxsize=1000):
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
 def use_ssl():
     if hasattr(settings, 'USE_SSL'):
         return settings.USE_SSL
     return False
 
 
+# Base URLs and full_reverse() results only change with the Site, USE_SSL,
+# the URLconf or (with i18n_patterns) the active language, so they are
+# memoized; saving or deleting a Site clears them.
+_base_urls = {}
+_full_reverse_cache = LRUCache(getattr(settings, 'FULL_REVERSE_CACHE_SIZE', 10000))
+
+
+def base_url(ssl=None, domain=None):
+    if ssl is None:
+        ssl = use_ssl()
+    try:
+        return _base_urls[ssl, domain]
+    except KeyError:
+        url = _base_urls[ssl, domain] = 'http%s://%s' % (
+            ssl and 's' or '',
+            domain or Site.objects.get_current().domain,
+        )
+        return url
+
+
+def clear_url_caches(**kwargs):
+    _base_urls.clear()
+    _full_reverse_cache.clear()
+
+post_save.connect(clear_url_caches, sender=Site)
+post_delete.connect(clear_url_caches, sender=Site)
+
+
 # Like reverse(), but returns an full URL 
 def full_reverse(*args, **kwargs):
+    from django.core.urlresolvers import get_script_prefix, get_urlconf
+    from django.utils import translation
+
     domain = kwargs.pop('rewrite_domain', None)
     ssl = kwargs.pop('use_ssl', use_ssl())
-    return 'http%s://%s%s' % (
-        ssl and 's' or '',
-        domain or Site.objects.get_current().domain,
-        reverse(*args, **kwargs)
-    )
+
+    try:
+        key = (_hashable(args), _hashable(kwargs),
+               domain, ssl, get_script_prefix(), get_urlconf(), translation.get_language())
+        hash(key)
+    except TypeError:
+        key = None
+
+    url = key and _full_reverse_cache.get(key)
+    if url is None:
+        url = base_url(ssl, domain) + reverse(*args, **kwargs)
+        if key:
+            _full_reverse_cache.set(key, url)
+    return url
+
+
+# reverse() arguments as a cache key: lists become tuples and dicts (e.g.
+# kwargs={'slug': ...}) sorted tuples of items
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
 
 
 def full_url(url):
-    return 'http%s://%s%s' % (
-        use_ssl() and 's' or '',
-        Site.objects.get_current().domain,
-        url
-    )
+    return base_url() + url
 
 
 def full_url_context(request):
     return {
-        'STATIC_URL': full_url(settings.STATIC_URL),
-        'MEDIA_URL': full_url(settings.MEDIA_URL),
-        'BASE_URL': 'http%s://%s' % (use_ssl() and 's' or '', Site.objects.get_current().domain),
+        'STATIC_URL': lazy(full_url, str)(settings.STATIC_URL),
+        'MEDIA_URL': lazy(full_url, str)(settings.MEDIA_URL),
+        'BASE_URL': lazy(base_url, str)(),
     }
 
 
@@ -148,6 +637,107 @@ def date_range(start, end):
     return dates
 
 
+def chunks(iterable, size):
+    """Yield lists of up to `size` items from any iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+"""
+Keyset (seek) pagination: pages are fetched with a WHERE on (field, pk)
+instead of an OFFSET, so page 10000 costs the same as page 1 given an index on
+(field, pk). Pages are addressed with opaque, signed cursors. The default
+ordering matches Base.Meta.ordering. Invalid cursors raise InvalidPage.
+"""
+class KeysetPaginator(object):
+    def __init__(self, queryset, per_page, field='date_created', descending=True):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.field = field
+        self.descending = descending
+
+    def page(self, cursor=None):
+        qs = self.queryset
+        backwards = False
+        if cursor:
+            backwards, value, pk = self.decode_cursor(cursor)
+            lookup = (self.descending != backwards) and 'lt' or 'gt'
+            qs = qs.filter(Q(**{'%s__%s' % (self.field, lookup): value}) |
+                           Q(**{self.field: value, 'pk__%s' % lookup: pk}))
+
+        prefix = (self.descending != backwards) and '-' or ''
+        rows = list(qs.order_by(prefix + self.field, prefix + 'pk')[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if backwards:
+            rows.reverse()
+            return KeysetPage(rows, self, has_next=True, has_previous=more)
+        return KeysetPage(rows, self, has_next=more, has_previous=bool(cursor))
+
+    def encode_cursor(self, obj, backwards=False):
+        value = obj[self.field] if isinstance(obj, dict) else getattr(obj, self.field)
+        pk = obj['pk'] if isinstance(obj, dict) else obj.pk
+        if isinstance(value, datetime.datetime):
+            value = {'dt': value.strftime('%Y-%m-%d %H:%M:%S.%f')}
+        elif isinstance(value, datetime.date):
+            value = {'d': value.strftime('%Y-%m-%d')}
+        return signing.dumps([backwards and 1 or 0, value, pk], salt='common.keyset', compress=True)
+
+    def decode_cursor(self, cursor):
+        try:
+            backwards, value, pk = signing.loads(cursor, salt='common.keyset')
+            if isinstance(value, dict) and 'dt' in value:
+                value = datetime.datetime.strptime(value['dt'], '%Y-%m-%d %H:%M:%S.%f')
+            elif isinstance(value, dict) and 'd' in value:
+                value = datetime.datetime.strptime(value['d'], '%Y-%m-%d').date()
+        except (signing.BadSignature, ValueError, TypeError):
+            raise InvalidPage('Invalid cursor')
+        return bool(backwards), value, pk
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<KeysetPage of %d objects>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return self.paginator.encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return self.paginator.encode_cursor(self.object_list[0], backwards=True)
+
+
 # returns a tuple (n, obj) where n means:
 #     0: nothing changed
 #     1: updated object
@@ -167,50 +757,775 @@ def create_or_update(model_class, filter_attrs, attrs, create_attrs={}, update_a
         return 2, obj
 
 
+# Batched create_or_update(): each record is a dict of attrs that includes the
+# key_fields. Existing rows are fetched with one query per chunk and compared in
+# memory; new rows are bulk inserted and changed rows written with bulk_update().
+# Returns a list of (n, obj) tuples in record order, with n as above. As
+# bulk_create() never sets pks, created rows are fetched back by key (one more
+# query per chunk) so every returned object is saved, like create_or_update().
+# A key repeated within `records` is created once and updated by the later
+# records.
+def bulk_create_or_update(model_class, records, key_fields, create_attrs={}, update_attrs={},
+                          batch_size=500, skip_validation=False):
+    opts = model_class._meta
+    manager = model_class.objects
+    results = []
+
+    for batch in chunks(records, batch_size):
+        batch_start = len(results)
+        lookup = {}
+        for field_name in key_fields:
+            lookup['%s__in' % field_name] = set(_prep_value(opts, field_name, record[field_name])
+                                                for record in batch)
+        existing = {}
+        for row in manager.filter(**lookup):
+            key = tuple(_row_value(opts, row, field_name) for field_name in key_fields)
+            existing.setdefault(key, []).append(row)
+
+        created, changed = [], {}
+        for record in batch:
+            key = tuple(_prep_value(opts, field_name, record[field_name]) for field_name in key_fields)
+            attrs = dict((k, v) for k, v in record.iteritems() if k not in key_fields)
+            if key not in existing:
+                obj = model_class(**dict(record, **create_attrs))
+                existing[key] = [obj]
+                created.append((key, obj))
+                results.append((2, obj))
+                continue
+
+            rows = existing[key]
+            status = 0
+            for row in rows:
+                if any(_row_value(opts, row, k) != _prep_value(opts, k, v) for k, v in attrs.iteritems()):
+                    for k, v in dict(attrs, **update_attrs).iteritems():
+                        setattr(row, opts.get_field(k).attname, _prep_value(opts, k, v))
+                    if row.pk is not None:
+                        changed[id(row)] = row
+                    status = 1
+            results.append((status, rows[0]))
+
+        if hasattr(manager, 'bulk_save'):
+            manager.bulk_save([obj for key, obj in created], batch_size=batch_size,
+                              skip_validation=skip_validation)
+        else:
+            manager.bulk_create([obj for key, obj in created])
+
+        if created:
+            lookup = {}
+            for idx, field_name in enumerate(key_fields):
+                lookup['%s__in' % field_name] = set(key[idx] for key, obj in created)
+            saved = dict((tuple(_row_value(opts, row, field_name) for field_name in key_fields), row)
+                         for row in manager.filter(**lookup))
+            fetched = dict((id(obj), saved.get(key, obj)) for key, obj in created)
+            for idx in range(batch_start, len(results)):
+                status, obj = results[idx]
+                results[idx] = (status, fetched.get(id(obj), obj))
+
+        if changed:
+            fields = set()
+            for record in batch:
+                fields.update(k for k in record if k not in key_fields)
+            fields.update(update_attrs)
+            bulk_update(model_class, changed.values(), fields=fields, batch_size=batch_size,
+                        using=manager.db)
+
+    return results
+
+
+def _prep_value(opts, field_name, value):
+    field = opts.get_field(field_name)
+    if isinstance(value, models.Model):
+        return value.pk
+    return field.to_python(value)
+
+
+def _row_value(opts, row, field_name):
+    return getattr(row, opts.get_field(field_name).attname)
+
+
+# SQLite refuses statements with more than 999 parameters
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+
+# Shrink batch_size so a statement with `params_per_row` parameters per row
+# stays within the database's parameter limit.
+def query_batch_size(using, params_per_row, batch_size):
+    if getattr(connections[using], 'vendor', None) == 'sqlite':
+        batch_size = min(batch_size, SQLITE_MAX_VARIABLE_NUMBER // max(params_per_row, 1))
+    return max(batch_size, 1)
+
+
+# Write `fields` (all non-pk concrete fields by default) of saved instances
+# with one UPDATE ... CASE statement per batch. Like QuerySet.update(), this
+# does not call save() or send signals. Only the model's own table is
+# written, so fields inherited from a multi-table parent can't be updated.
+def bulk_update(model_class, instances, fields=None, batch_size=500, using=None):
+    opts = model_class._meta
+    pk_field = opts.pk
+    if fields:
+        fields = [opts.get_field(name) for name in fields]
+        inherited = [f.name for f in fields if f not in opts.local_fields]
+        if inherited:
+            raise ValueError("bulk_update() can't update fields of %s's parent models: %s"
+                             % (opts.object_name, ', '.join(inherited)))
+    else:
+        fields = [f for f in opts.local_fields if not f.primary_key]
+
+    using = using or router.db_for_write(model_class)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    # Postgres types untyped CASE results as text, so cast them back
+    cast = getattr(connection, 'vendor', None) == 'postgresql'
+
+    cursor = connection.cursor()
+    batch_size = query_batch_size(using, 2 * len(fields) + 1, batch_size)
+    for batch in chunks(instances, batch_size):
+        assignments, params = [], []
+        for field in fields:
+            then = cast and 'CAST(%%s AS %s)' % field.db_type(connection) or '%s'
+            whens = []
+            for obj in batch:
+                whens.append('WHEN %%s THEN %s' % then)
+                params.append(obj.pk)
+                params.append(field.get_db_prep_save(getattr(obj, field.attname), connection=connection))
+            assignments.append('%s = CASE %s %s END' % (
+                qn(field.column), qn(pk_field.column), ' '.join(whens)))
+        params.extend(obj.pk for obj in batch)
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(opts.db_table),
+            ', '.join(assignments),
+            qn(pk_field.column),
+            ', '.join(['%s'] * len(batch)),
+        ), params)
+    transaction.commit_unless_managed(using=using)
+
+
 # SQL
-def sql(cursor, sql):
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+def sql(cursor, sql, params=None):
+    return list(iter_sql(cursor, sql, params))
+
+
+# Row factories for iter_sql(); each takes the column names once and returns
+# a function that builds a row from a tuple.
+def dict_row_factory(columns):
+    return lambda row: dict(zip(columns, row))
+
 
-    cursor.execute(sql)
-    rows = [dict_factory(cursor, row) for row in cursor.fetchall()]
-    return rows
+def namedtuple_row_factory(columns):
+    from collections import namedtuple
+    return namedtuple('Row', columns, rename=True)._make
 
 
-def render_html_email(name, context):
+def tuple_row_factory(columns):
+    return tuple
+
+
+ROW_FACTORIES = {
+    'dict': dict_row_factory,
+    'namedtuple': namedtuple_row_factory,
+    'tuple': tuple_row_factory,
+}
+
+
+# Like sql(), but a generator that reads `chunk_size` rows at a time with
+# fetchmany(). row_factory is one of ROW_FACTORIES, a callable taking the
+# column names, or 'columns' to yield one {column: [values]} dict per chunk.
+def iter_sql(cursor, sql, params=None, row_factory='dict', chunk_size=1000):
+    if params is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql, params)
+
+    # Named cursors only fill in description after the first fetch
+    rows = cursor.fetchmany(chunk_size)
+    columns = [col[0] for col in cursor.description]
+
+    if row_factory == 'columns':
+        while rows:
+            yield dict(zip(columns, [list(values) for values in zip(*rows)]))
+            rows = cursor.fetchmany(chunk_size)
+        return
+
+    if not callable(row_factory):
+        row_factory = ROW_FACTORIES[row_factory]
+    make_row = row_factory(columns)
+
+    while rows:
+        for row in rows:
+            yield make_row(row)
+        rows = cursor.fetchmany(chunk_size)
+
+
+# A cursor for iter_sql() that keeps the result set on the server where the
+# backend supports it (a psycopg2 named cursor), so only one chunk is held in
+# memory. Must be used inside a transaction; falls back to a regular cursor.
+def streaming_cursor(using='default', chunk_size=1000):
+    import uuid
+
+    connection = connections[using]
+    connection.cursor()  # make sure the connection is open
+    if getattr(connection, 'vendor', None) == 'postgresql':
+        cursor = connection.connection.cursor(name='stream_%s' % uuid.uuid4().hex)
+        cursor.itersize = chunk_size
+        return cursor
+    return connection.cursor()
+
+
+# Set precompile=True (or HTML_EMAIL_PRECOMPILE = True) to render from a
+# template with the CSS inlined once (see get_inlined_template) instead of
+# inlining the CSS of every rendered output.
+def render_html_email(name, context, precompile=None):
     import pynliner
 
+    if precompile is None:
+        precompile = getattr(settings, 'HTML_EMAIL_PRECOMPILE', False)
+
     subject = loader.render_to_string('%s.subj.txt' % name, context).strip()
     text_body = loader.render_to_string('%s.body.txt' % name, context)
-    html_body = loader.render_to_string('%s.body.html' % name, context)
 
-    css_body = loader.render_to_string(['%s.css' % name])
+    template = precompile and get_inlined_template(name)
+    if template:
+        if not isinstance(context, Context):
+            context = Context(context)
+        html_body = template.render(context)
+    else:
+        html_body = loader.render_to_string('%s.body.html' % name, context)
+        css_body = loader.render_to_string(['%s.css' % name])
 
-    # convert to inline-css
-    html_body = pynliner.Pynliner().from_string(html_body).with_cssString(css_body).run()
+        # convert to inline-css
+        html_body = pynliner.Pynliner().from_string(html_body).with_cssString(css_body).run()
 
     return subject, text_body, html_body
 
 
+# Template syntax is swapped for placeholders while the template source goes
+# through pynliner, then restored.
+_TEMPLATE_SYNTAX_RE = re.compile(r'{{.*?}}|{%.*?%}|{#.*?#}', re.DOTALL)
+
+# Sources where the matched CSS can change with the context: template syntax
+# in a tag name, a class/id/style attribute, in place of an attribute or as a
+# block tag inside a tag; markup injected unescaped (|safe, autoescape off);
+# or markup that lives in another template. Variables in other attribute
+# values (href, src, alt...) don't affect selectors.
+_CONTEXT_DEPENDENT_CSS_RE = re.compile(r"""
+    <\s*/?\s*{[{%]
+  | <[^>]*{%
+  | \b(?:class|id|style)\s*=\s*["']?[^"'>]*{[{%]
+  | <[a-zA-Z][^>]*\s{{
+  | \|\s*safe
+  | {%\s*(?:autoescape\s+off|extends|include|block)\b
+""", re.VERBOSE)
+
+_inlined_templates = {}
+
+
+# Returns the `<name>.body.html` template with `<name>.css` already inlined,
+# compiled once per modification time of both sources, or None if the template
+# has to be inlined per render.
+def get_inlined_template(name):
+    import os
+    import pynliner
+
+    key = [name]
+    # the body goes last so `source` ends up holding it
+    for template_name in ('%s.css' % name, '%s.body.html' % name):
+        source, path = _load_template_source(template_name)
+        try:
+            mtime = os.path.getmtime(path)
+        except (OSError, TypeError):
+            mtime = None
+        key.extend((path, mtime))
+    key = tuple(key)
+    if key in _inlined_templates:
+        return _inlined_templates[key]
+
+    template = None
+    if not _CONTEXT_DEPENDENT_CSS_RE.search(source):
+        tags = []
+        def placeholder(match):
+            tags.append(match.group(0))
+            return 'INLINEPLACEHOLDER%dX' % (len(tags) - 1)
+
+        css_body = loader.render_to_string(['%s.css' % name])
+        inlined = pynliner.Pynliner().from_string(
+            _TEMPLATE_SYNTAX_RE.sub(placeholder, source)).with_cssString(css_body).run()
+
+        # Give up if the HTML parser moved or dropped any template syntax
+        if all(inlined.count('INLINEPLACEHOLDER%dX' % i) == 1 for i in range(len(tags))):
+            for i, tag in enumerate(tags):
+                inlined = inlined.replace('INLINEPLACEHOLDER%dX' % i, tag)
+            template = Template(inlined)
+
+    _inlined_templates[key] = template
+    return template
+
+
+def _load_template_source(template_name):
+    from django.template import TemplateDoesNotExist
+    from django.template.loader import find_template_loader
+
+    loaders = [find_template_loader(name) for name in settings.TEMPLATE_LOADERS]
+    while loaders:
+        template_loader = loaders.pop(0)
+        if template_loader is None:
+            continue
+        if hasattr(template_loader, 'loaders'):
+            # the cached loader wraps the ones that can return sources
+            loaders[:0] = template_loader.loaders
+            continue
+        try:
+            return template_loader.load_template_source(template_name)
+        except (TemplateDoesNotExist, NotImplementedError):
+            pass
+    raise TemplateDoesNotExist(template_name)
+
+
+# Render and send `name` emails for many contexts. Batches of `batch_size`
+# contexts are handed to `workers` threads, each holding one backend connection
+# (one SMTP session) open for all of its batches and sending each batch with a
+# single send_messages() call. Recipients come from context[recipient_key] (an
+# address or a list). Messages without recipients or that fail to render or
+# build are collected per message without aborting their batch; a transport
+# error fails the rest of the batch (some of which may already have been
+# delivered) and the worker reconnects. Any other error fails its whole batch
+# and the worker carries on. Returns {'sent', 'failed': [(recipients, exception)], 'seconds',
+# 'per_second'}.
+def send_html_emails(name, contexts, from_email=None, recipient_key='email', batch_size=100,
+                     workers=4, precompile=None):
+    from django.core.mail import get_connection
+
+    started = time.time()
+    batches = Queue.Queue(workers * 2)
+    results = {'sent': 0, 'failed': []}
+    lock = threading.Lock()
+
+    def work():
+        try:
+            connection, connection_error = get_connection(), None
+        except Exception, exc:
+            connection, connection_error = None, exc
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                try:
+                    if connection_error is not None:
+                        raise connection_error
+                    sent, failed = _send_html_email_batch(name, batch, from_email, recipient_key,
+                                                          connection, precompile)
+                except Exception, exc:
+                    sent, failed = 0, [(_email_recipients(context, recipient_key, False), exc)
+                                       for context in batch]
+                with lock:
+                    results['sent'] += sent
+                    results['failed'].extend(failed)
+        finally:
+            if connection is not None:
+                connection.close()
+            for alias in connections:
+                connections[alias].close()
+
+    def put(item):
+        # never block on a queue nobody is left to read
+        while True:
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                if not any(thread.is_alive() for thread in threads):
+                    return False
+
+    threads = [threading.Thread(target=work, name='send_html_emails-%d' % i) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for batch in chunks(contexts, batch_size):
+            if not put(batch):
+                raise RuntimeError('send_html_emails workers died')
+    finally:
+        for thread in threads:
+            put(None)
+        for thread in threads:
+            thread.join()
+
+    results['seconds'] = time.time() - started
+    results['per_second'] = results['sent'] / max(results['seconds'], 1e-6)
+    return results
+
+
+def _email_recipients(context, recipient_key, required=True):
+    try:
+        to = context[recipient_key]
+    except (KeyError, TypeError):
+        if required:
+            raise
+        return None
+    if isinstance(to, basestring):
+        to = [to]
+    return to
+
+
+def _send_html_email_batch(name, contexts, from_email, recipient_key, connection, precompile=None):
+    messages, failed = [], []
+    for context in contexts:
+        to = None
+        try:
+            to = _email_recipients(context, recipient_key)
+            subject, text_body, html_body = render_html_email(name, context, precompile)
+            message = EmailMultiAlternatives(subject, text_body, from_email, to, connection=connection)
+            message.attach_alternative(html_body, 'text/html')
+            # build the MIME message now so bad headers fail this message only
+            message.message()
+        except Exception, exc:
+            failed.append((to, exc))
+            continue
+        messages.append(message)
+
+    if not messages:
+        return 0, failed
+
+    try:
+        # a no-op while the worker's session is still open; send_messages()
+        # would otherwise open and close a session of its own
+        connection.open()
+        sent = connection.send_messages(messages) or 0
+    except Exception, exc:
+        failed.extend((message.to, exc) for message in messages)
+        # start a fresh session in case the failure broke the connection
+        connection.close()
+        return 0, failed
+    return sent, failed
+
+
 # JSON
+def encode_default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return str(obj).split('.')[0]
+    if isinstance(obj, datetime.date):
+        return str(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
 class Encoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-        if isinstance(obj, datetime.datetime):
-            return str(obj).split('.')[0]
-        if isinstance(obj, datetime.date):
-            return str(obj)
-        return obj
+        return encode_default(obj)
 
 
-def format_us_phone_number(value):
+# Serialize obj as JSON in pieces, without building the whole document.
+# QuerySets (read with iterator(), so values() and values_list() rows work
+# too), lists, tuples and generators are streamed item by item, dicts key by
+# key, and model instances become a dict of their concrete fields. Everything
+# else is encoded with Encoder. Pieces are buffered to about `chunk_size` chars.
+def iter_json(obj, chunk_size=8192):
+    buf, size = [], 0
+    for piece in _iter_json(obj, Encoder()):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _iter_json(obj, encoder):
+    from django.db.models.query import QuerySet
+
+    if isinstance(obj, models.Model):
+        obj = model_to_json_dict(obj)
+
+    if isinstance(obj, dict):
+        yield '{'
+        for idx, (key, value) in enumerate(obj.iteritems()):
+            yield idx and ', ' or ''
+            yield encoder.encode(key if isinstance(key, basestring) else unicode(key))
+            yield ': '
+            for piece in _iter_json(value, encoder):
+                yield piece
+        yield '}'
+    elif isinstance(obj, (list, tuple, QuerySet)) or hasattr(obj, 'next'):
+        if isinstance(obj, QuerySet):
+            obj = obj.iterator()
+        yield '['
+        for idx, item in enumerate(obj):
+            yield idx and ', ' or ''
+            if isinstance(item, models.Model):
+                item = model_to_json_dict(item)
+            if isinstance(item, (dict, list, tuple)) and not _is_nested(item):
+                yield encoder.encode(item)
+            else:
+                for piece in _iter_json(item, encoder):
+                    yield piece
+        yield ']'
+    else:
+        yield encoder.encode(obj)
+
+
+# True if a model instance, queryset or iterator appears anywhere in obj
+def _is_nested(obj):
+    from django.db.models.query import QuerySet
+
+    values = obj.itervalues() if isinstance(obj, dict) else obj
+    for value in values:
+        if isinstance(value, (models.Model, QuerySet)) or hasattr(value, 'next'):
+            return True
+        if isinstance(value, (dict, list, tuple)) and _is_nested(value):
+            return True
+    return False
+
+
+def model_to_json_dict(obj):
+    return dict((f.attname, getattr(obj, f.attname)) for f in obj._meta.fields)
+
+
+"""
+JSON codecs give JSONField (and anything else that wants it) a dumps/loads
+pair with Encoder's handling of Decimal/datetime/date. Pick one globally with
+settings.JSON_CODEC or per field with JSONField(codec=...); the value is an
+alias from JSON_CODECS, a dotted path to a codec class, or 'auto' (the
+default) for simplejson when it is installed and the stdlib json otherwise.
+ujson is opt-in (JSON_CODEC = 'ujson'): it only speeds up decoding, and its
+float parsing differs from the other codecs unless asked to be precise.
+"""
+class JSONCodec(object):
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('cls', Encoder)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return json.loads(s, **kwargs)
+
+
+class SimpleJSONCodec(JSONCodec):
+    """simplejson with its C speedups"""
+    def __init__(self):
+        import simplejson
+        self.json = simplejson
+
+    def dumps(self, obj, **kwargs):
+        # the stdlib json (UltraJSONCodec's fallback) has no use_decimal
+        if 'cls' in kwargs or self.json is json:
+            return super(SimpleJSONCodec, self).dumps(obj, **kwargs)
+        kwargs.setdefault('default', encode_default)
+        kwargs.setdefault('use_decimal', False)
+        return self.json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return self.json.loads(s, **kwargs)
+
+
+class UltraJSONCodec(SimpleJSONCodec):
+    """
+    ujson for decoding only. ujson encodes Decimal as float and datetime as
+    epoch seconds with no way to override that, so encoding stays on
+    simplejson (or the stdlib json) to keep Encoder's output and is no faster
+    than SimpleJSONCodec. Floats are decoded with precise_float so they
+    round-trip the same as with the other codecs.
+    """
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+        try:
+            super(UltraJSONCodec, self).__init__()
+        except ImportError:
+            self.json = json
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return self.json.loads(s, **kwargs)
+        return self.ujson.loads(s, precise_float=True)
+
+
+JSON_CODECS = {
+    'json': 'common.utils.JSONCodec',
+    'simplejson': 'common.utils.SimpleJSONCodec',
+    'ujson': 'common.utils.UltraJSONCodec',
+}
+
+_json_codecs = {}
+
+
+def get_json_codec(name=None):
+    from django.utils.importlib import import_module
+
+    name = name or getattr(settings, 'JSON_CODEC', 'auto')
+    if name in _json_codecs:
+        return _json_codecs[name]
+
+    if name == 'auto':
+        candidates = ['simplejson', 'json']
+    else:
+        candidates = [name]
+
+    for candidate in candidates:
+        path = JSON_CODECS.get(candidate, candidate)
+        module, attr = path.rsplit('.', 1)
+        try:
+            codec = getattr(import_module(module), attr)()
+        except ImportError:
+            if candidate == candidates[-1]:
+                raise
+            continue
+        _json_codecs[name] = codec
+        return codec
+
+
+# Phone number parsing is expensive and the same values go through it on
+# every load, save and serialization, so conversions are memoized (including
+# parse failures, which are re-raised).
+_phone_number_caches = {
+    'e164': LRUCache(getattr(settings, 'PHONE_NUMBER_CACHE_SIZE', 10000)),
+    'international': LRUCache(getattr(settings, 'PHONE_NUMBER_CACHE_SIZE', 10000)),
+}
+
+E164_RE = re.compile(r'^\+[1-9]\d{1,14}$')
+
+
+class _ParseFailure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _cached_phone_conversion(cache_name, value, convert):
+    from phonenumbers.phonenumberutil import NumberParseException
+
+    if not isinstance(value, basestring):
+        return convert(value)
+
+    lru = _phone_number_caches[cache_name]
+    result = lru.get(value)
+    if result is None:
+        try:
+            result = convert(value)
+        except NumberParseException, exc:
+            result = _ParseFailure(exc)
+        lru.set(value, result)
+    if isinstance(result, _ParseFailure):
+        raise result.exc
+    return result
+
+
+def phone_number_cache_info():
+    return dict((name, lru.info()) for name, lru in _phone_number_caches.items())
+
+
+def _format_us_phone_number(value):
+    from phonenumbers.phonenumberutil import format_number, parse, PhoneNumberFormat
+
     phone = parse(value, 'US')
     formatted = format_number(phone, PhoneNumberFormat.E164)
     if phone.extension:
         formatted += 'x%s' % phone.extension
     return formatted
 
+
+def format_us_phone_number(value):
+    if isinstance(value, basestring) and E164_RE.match(value):
+        return value
+    return _cached_phone_conversion('e164', value, _format_us_phone_number)
+
+
+def _format_international_phone_number(value):
+    from phonenumbers.phonenumberutil import format_number, parse, PhoneNumberFormat
+
+    return format_number(parse(value, 'US'), PhoneNumberFormat.INTERNATIONAL)
+
+
+def format_international_phone_number(value):
+    return _cached_phone_conversion('international', value, _format_international_phone_number)
+
+
+class _PhoneRow(object):
+    """Just enough of a model instance for bulk_update()"""
+    def __init__(self, pk, values):
+        self.pk = pk
+        self.__dict__.update(values)
+
+
+def _normalize_phone_rows(rows):
+    from phonenumbers.phonenumberutil import NumberParseException
+
+    results = []
+    for pk, values in rows:
+        normalized, failed = {}, {}
+        for attname, value in values.iteritems():
+            if not value:
+                continue
+            try:
+                formatted = format_us_phone_number(value)
+            except NumberParseException:
+                failed[attname] = value
+                continue
+            if formatted != value:
+                normalized[attname] = formatted
+        results.append((pk, normalized, failed))
+    return results
+
+
+# Rewrite the PhoneNumberField columns of an existing table in E164 form.
+# Rows are read in pk order `chunk_size` at a time, normalized across a
+# process pool (pass processes=1 to stay in-process) and written back with
+# bulk_update(). Resume from a checkpoint with start_pk; on_chunk(stats) is
+# called after every chunk. Returns stats with the row counts, the last pk
+# and a list of (pk, attname, value) that could not be parsed.
+def normalize_phone_numbers(model_class, fields=None, chunk_size=1000, processes=None,
+                            start_pk=None, dry_run=False, on_chunk=None):
+    from multiprocessing import Pool, cpu_count
+    from common.fields import PhoneNumberField
+
+    opts = model_class._meta
+    if fields:
+        fields = [opts.get_field(name) for name in fields]
+    else:
+        fields = [f for f in opts.fields if isinstance(f, PhoneNumberField)]
+    attnames = [f.attname for f in fields]
+
+    stats = {'rows': 0, 'updated': 0, 'unparseable': [], 'last_pk': start_pk}
+    processes = processes or cpu_count()
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        while True:
+            qs = model_class._base_manager.order_by('pk')
+            if stats['last_pk'] is not None:
+                qs = qs.filter(pk__gt=stats['last_pk'])
+            rows = [(row[0], dict(zip(attnames, row[1:])))
+                    for row in qs.values_list('pk', *attnames)[:chunk_size]]
+            if not rows:
+                break
+
+            if pool:
+                per_worker = max(1, len(rows) / processes)
+                results = sum(pool.map(_normalize_phone_rows, list(chunks(rows, per_worker))), [])
+            else:
+                results = _normalize_phone_rows(rows)
+
+            changed, changed_fields = [], set()
+            for pk, normalized, failed in results:
+                stats['unparseable'].extend((pk, attname, value) for attname, value in failed.iteritems())
+                if normalized:
+                    changed.append(_PhoneRow(pk, normalized))
+                    changed_fields.update(normalized)
+
+            if changed and not dry_run:
+                # Rows only carry the columns that changed, so fill in the rest
+                current = dict(rows)
+                for row in changed:
+                    for attname in changed_fields:
+                        row.__dict__.setdefault(attname, current[row.pk][attname])
+                bulk_update(model_class, changed, fields=[f.name for f in fields if f.attname in changed_fields],
+                            batch_size=chunk_size)
+
+            stats['rows'] += len(rows)
+            stats['updated'] += len(changed)
+            stats['last_pk'] = rows[-1][0]
+            if on_chunk:
+                on_chunk(stats)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return stats
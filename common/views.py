@@ -1,15 +1,26 @@
 import json
+import hashlib
 
+from django.core.cache import cache
+from django.core.paginator import InvalidPage
 from django.views.generic import FormView
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from django.views.generic.base import TemplateResponseMixin
 from django.views.generic.edit import FormMixin, ProcessFormView
-from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseNotModified, Http404, HttpResponseRedirect
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_backends, SESSION_KEY, BACKEND_SESSION_KEY
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Before Django 1.5 an HttpResponse given an iterator streams it
+    StreamingHttpResponse = HttpResponse
+
+from common.utils import iter_csv, iter_json, KeysetPaginator
+
 
 class MultipleFormsMixin(FormMixin):
     """
@@ -64,18 +75,99 @@ class MultipleFormsView(TemplateResponseMixin, BaseMultipleFormsView):
 
 
 class JSONResponseMixin(object):
+    # Set to True to serialize the context incrementally into a streaming
+    # response (see common.utils.iter_json) instead of one big string.
+    stream_json = False
+
+    # GET/HEAD responses carry an ETag and are answered with a 304 when it
+    # matches If-None-Match. When get_json_version() returns a version (for
+    # example the max date_updated of the rows behind the response), a weak
+    # ETag is derived from it without serializing anything; otherwise a strong
+    # ETag is computed from the serialized content. With a version available,
+    # json_cache_timeout also keeps the serialized content in the cache.
+    json_etags = True
+    json_cache_timeout = None
+
     def render_to_response(self, context):
         "Returns a JSON response containing 'context' as payload"
+        if not self.json_etags or self.request.method not in ('GET', 'HEAD'):
+            return self.render_json(context)
+
+        version = self.get_json_version(context)
+        if version is None:
+            if self.stream_json:
+                return self.render_json(context)
+            content = self.convert_context_to_json(context)
+            digest = hashlib.md5(content.encode('utf-8') if isinstance(content, unicode) else content)
+            etag = '"%s"' % digest.hexdigest()
+            if self.etag_matches(etag):
+                return self.get_not_modified_response(etag)
+            response = self.get_json_response(content)
+        else:
+            cache_key = self.get_json_cache_key(version)
+            etag = 'W/"%s"' % cache_key
+            if self.etag_matches(etag):
+                return self.get_not_modified_response(etag)
+
+            if self.json_cache_timeout:
+                content = cache.get(cache_key)
+                if content is None:
+                    content = self.convert_context_to_json(context)
+                    cache.set(cache_key, content, self.json_cache_timeout)
+                response = self.get_json_response(content)
+            else:
+                response = self.render_json(context)
+
+        response['ETag'] = etag
+        return response
+
+    def render_json(self, context):
+        if self.stream_json:
+            return self.get_streaming_json_response(iter_json(context))
         return self.get_json_response(self.convert_context_to_json(context))
 
+    def get_json_version(self, context):
+        "Return a cheap version identifier of the response content, or None."
+        return None
+
+    def get_json_cache_key(self, version):
+        user = getattr(self.request, 'user', None)
+        return 'json:%s' % hashlib.md5('%s|%s|%s' % (
+            self.request.get_full_path(),
+            user is not None and user.is_authenticated() and user.pk or '',
+            version,
+        )).hexdigest()
+
+    def etag_matches(self, etag):
+        header = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if not header:
+            return False
+        # If-None-Match uses weak comparison
+        strip_weak = lambda tag: tag[2:] if tag.startswith('W/') else tag
+        tags = [strip_weak(tag.strip()) for tag in header.split(',')]
+        return '*' in tags or strip_weak(etag) in tags
+
+    def get_not_modified_response(self, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
     def get_json_response(self, content, **httpresponse_kwargs):
         "Construct an `HttpResponse` object."
         return HttpResponse(content,
                                  content_type='application/json',
                                  **httpresponse_kwargs)
 
+    def get_streaming_json_response(self, content, **httpresponse_kwargs):
+        "Construct a streaming response from an iterator of JSON pieces."
+        return StreamingHttpResponse(content,
+                                     content_type='application/json',
+                                     **httpresponse_kwargs)
+
     def convert_context_to_json(self, context):
         "Convert the context dictionary into a JSON object"
+        if self.stream_json:
+            return ''.join(iter_json(context))
         # Note: This is *EXTREMELY* naive; in reality, you'll need
         # to do much more complex handling to ensure that arbitrary
         # objects -- such as Django model instances or querysets
@@ -87,6 +179,42 @@ class JSONFormView(JSONResponseMixin, FormView):
     pass
 
 
+def csv_response(queryset, filename, **kwargs):
+    """
+    Stream a queryset as a CSV download. Keyword arguments are passed to
+    common.utils.iter_csv.
+    """
+    response = StreamingHttpResponse(iter_csv(queryset, **kwargs), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+class KeysetPaginationMixin(object):
+    """
+    Paginate with common.utils.KeysetPaginator using the `cursor` GET
+    parameter instead of page numbers. In a ListView the context gets the
+    usual paginator/page_obj/is_paginated, with page_obj.next_cursor and
+    page_obj.previous_cursor for building links. JSONResponseMixin views can
+    call get_keyset_page() and put the page's object_list and cursors in
+    their context.
+    """
+    keyset_field = 'date_created'
+    keyset_descending = True
+    cursor_kwarg = 'cursor'
+
+    def get_keyset_page(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size, field=self.keyset_field,
+                                    descending=self.keyset_descending)
+        try:
+            return paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidPage, exc:
+            raise Http404(unicode(exc))
+
+    def paginate_queryset(self, queryset, page_size):
+        page = self.get_keyset_page(queryset, page_size)
+        return (page.paginator, page, page.object_list, page.has_other_pages())
+
+
 class LoginRequiredMixin(object):
     @method_decorator(login_required)
     def dispatch(self, *args, **kwargs):
@@ -123,3 +251,11 @@ def su(request, user_id):
 
     return HttpResponseRedirect('/')
 
+
+"""
+JSON dump of the per-endpoint aggregates collected by SQLProfilerMiddleware
+"""
+@staff_member_required
+def sql_profile(request):
+    from common.middleware import sql_profile
+    return HttpResponse(json.dumps(sql_profile.report(), indent=2), content_type='application/json')